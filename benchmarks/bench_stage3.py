@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""Benchmark of the stage3 manifest rewriting on a synthetic workspace.
+
+A workspace with hundreds of sibling git repositories, cloned from local
+bare repositories, is generated with large go.mod, requirements.txt,
+pyproject.toml, package.json and requirements.yml files in the main
+directory. The discovery of the repositories and each process_* function
+are then timed, reporting the duration and the peak Python memory of each
+phase. The processors are timed cold, with the module caches cleared
+before each iteration like in a new stage3 process, and warm, with the
+caches filled by the previous iterations like for the next work
+directories of an in-process stage3 run. No network access is needed.
+
+Usage: bench_stage3.py [--repos N] [--lines N] [--iterations N] [--json FILE]
+"""
+
+import argparse
+import contextlib
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+TOP_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, TOP_DIR)
+
+from depends_on import ansible, golang, javascript, python  # noqa: E402
+from depends_on.ansible import process_ansible  # noqa: E402
+from depends_on.golang import process_golang  # noqa: E402
+from depends_on.javascript import process_javascript  # noqa: E402
+from depends_on.python import (  # noqa: E402
+    process_python_pyproject,
+    process_python_requirements,
+)
+from depends_on.stage3 import directories  # noqa: E402
+
+MANIFESTS = (
+    "go.mod",
+    "requirements.txt",
+    "pyproject.toml",
+    "package.json",
+    "requirements.yml",
+)
+
+# caches of the processors kept between the calls in the same process
+CACHES = (
+    python._NAME_CACHE,
+    golang._MOD_FILE_CACHE,
+    javascript._PACKAGE_INDEX_CACHE,
+    ansible._NAME_CACHE,
+)
+
+
+def git(*args, cwd=None):
+    "Run a git command without output."
+    subprocess.run(
+        ["git", "-c", "user.name=bench", "-c", "user.email=bench@localhost", *args],
+        cwd=cwd,
+        check=True,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+
+
+def write(path, content):
+    "Write content to path, creating the parent directories."
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="UTF-8") as out_stream:
+        out_stream.write(content)
+
+
+def create_dependency(bare_dir, top_dir, idx):
+    "Create the bare repository of dependency idx and clone it in top_dir."
+    name = f"repo{idx}"
+    src = os.path.join(bare_dir, "src", name)
+    write(os.path.join(src, "go.mod"), f"module github.com/bench/{name}\n\ngo 1.21\n")
+    write(
+        os.path.join(src, "setup.py"),
+        f'from setuptools import setup\n\nsetup(\n    name="bench_{name}",\n)\n',
+    )
+    write(
+        os.path.join(src, "package.json"),
+        json.dumps({"name": f"bench-{name}", "version": "1.0.0"}, indent=2),
+    )
+    write(
+        os.path.join(src, "galaxy.yml"),
+        f"namespace: bench\nname: {name}\nversion: 1.0.0\n",
+    )
+    git("init", "--quiet", src)
+    git("add", ".", cwd=src)
+    git("commit", "--quiet", "-m", "initial", cwd=src)
+    bare = os.path.join(bare_dir, f"{name}.git")
+    git("clone", "--quiet", "--bare", src, bare)
+    shutil.rmtree(src)
+    clone = os.path.join(top_dir, name)
+    git("clone", "--quiet", f"file://{bare}", clone)
+    # the repository name is computed from the origin URL
+    git("remote", "set-url", "origin", f"https://github.com/bench/{name}", cwd=clone)
+    write(
+        os.path.join(clone, "depends-on.json"),
+        json.dumps(
+            {
+                "fork_url": f"https://github.com/fork/{name}.git",
+                "branch": "feature",
+                "main_url": f"https://github.com/bench/{name}.git",
+                "main_branch": "main",
+                "top_dir": clone,
+                "path": clone,
+            },
+            indent=2,
+        ),
+    )
+
+
+def create_main(main_dir, nb_repos, nb_lines):
+    "Create the manifests of the main directory."
+    repos = [f"repo{idx}" for idx in range(nb_repos)]
+    fillers = [f"filler{idx}" for idx in range(nb_lines)]
+    go_mod = "module github.com/bench/main\n\ngo 1.21\n\nrequire (\n"
+    go_mod += "".join(f"\tgithub.com/bench/{r} v0.0.0\n" for r in repos)
+    # exclude directives make the file large without needing the network for tidy
+    go_mod += ")\n\nexclude (\n"
+    go_mod += "".join(f"\tgithub.com/filler/{f} v1.0.0\n" for f in fillers)
+    go_mod += ")\n"
+    write(os.path.join(main_dir, "go.mod"), go_mod)
+    write(
+        os.path.join(main_dir, "requirements.txt"),
+        "".join(f"{f}==1.0.0\n" for f in fillers)
+        + "".join(f"bench_{r}==1.0.0\n" for r in repos),
+    )
+    write(
+        os.path.join(main_dir, "pyproject.toml"),
+        '[tool.poetry]\nname = "bench-main"\n\n[tool.poetry.dependencies]\n'
+        + 'python = "^3.8"\n'
+        + "".join(f'{f} = "^1.0"\n' for f in fillers)
+        + "".join(f'bench_{r} = "^1.0"\n' for r in repos),
+    )
+    dependencies = {f"filler-{f}": "^1.0.0" for f in fillers}
+    dependencies.update({f"bench-{r}": "^1.0.0" for r in repos})
+    write(
+        os.path.join(main_dir, "package.json"),
+        json.dumps(
+            {"name": "bench-main", "version": "1.0.0", "dependencies": dependencies},
+            indent=2,
+        ),
+    )
+    write(
+        os.path.join(main_dir, "requirements.yml"),
+        "---\ncollections:\n"
+        + "".join(f"  - name: filler.{f}\n" for f in fillers)
+        + "".join(f"  - name: bench.{r}\n" for r in repos),
+    )
+    git("init", "--quiet", main_dir)
+    git("remote", "add", "origin", "https://github.com/bench/main", cwd=main_dir)
+
+
+def create_workspace(work_dir, nb_repos, nb_lines):
+    "Create the synthetic workspace and return the main directory."
+    bare_dir = os.path.join(work_dir, "bare")
+    top_dir = os.path.join(work_dir, "top")
+    os.makedirs(bare_dir)
+    os.makedirs(top_dir)
+    for idx in range(nb_repos):
+        create_dependency(bare_dir, top_dir, idx)
+    main_dir = os.path.join(top_dir, "main")
+    create_main(main_dir, nb_repos, nb_lines)
+    return main_dir
+
+
+@contextlib.contextmanager
+def quiet_stderr():
+    "Silence the log messages written to stderr, including by subprocesses."
+    sys.stderr.flush()
+    saved_fd = os.dup(2)
+    saved_stderr = sys.stderr
+    with open(os.devnull, "w") as devnull:
+        os.dup2(devnull.fileno(), 2)
+        sys.stderr = devnull
+        try:
+            yield
+        finally:
+            sys.stderr = saved_stderr
+            os.dup2(saved_fd, 2)
+            os.close(saved_fd)
+
+
+def measure(name, func, iterations, reset=None):
+    "Run func iterations times and return its timings and peak Python memory."
+    durations = []
+    peak = 0
+    for _ in range(iterations):
+        if reset:
+            reset()
+        tracemalloc.start()
+        start = time.perf_counter()
+        with quiet_stderr():
+            result = func()
+        durations.append(time.perf_counter() - start)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return {
+        "phase": name,
+        "min": min(durations),
+        "mean": sum(durations) / len(durations),
+        "peak_kib": peak // 1024,
+        "result": result if isinstance(result, (bool, int)) else len(result),
+    }
+
+
+def main(args):
+    "Main function."
+    argparser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    argparser.add_argument("--repos", type=int, default=200)
+    argparser.add_argument("--lines", type=int, default=2000)
+    argparser.add_argument("--iterations", type=int, default=3)
+    argparser.add_argument("--container-mode", action="store_true")
+    argparser.add_argument("--json", help="write the results to this file")
+    argparser.add_argument("--keep", action="store_true", help="keep the workspace")
+    parsed_args = argparser.parse_args(args[1:])
+
+    work_dir = tempfile.mkdtemp(prefix="depends-on-bench-")
+    # go mod tidy must not use the network
+    os.environ["GOPROXY"] = "off"
+    os.environ["GOFLAGS"] = "-mod=mod"
+    saved_cwd = os.getcwd()
+    try:
+        start = time.perf_counter()
+        main_dir = create_workspace(work_dir, parsed_args.repos, parsed_args.lines)
+        print(
+            f"workspace with {parsed_args.repos} repositories created in "
+            f"{time.perf_counter() - start:.1f}s: {work_dir}",
+            file=sys.stderr,
+        )
+        top_dir = os.path.dirname(main_dir)
+        originals = {}
+        for manifest in MANIFESTS:
+            with open(os.path.join(main_dir, manifest), encoding="UTF-8") as stream:
+                originals[manifest] = stream.read()
+
+        def reset_warm():
+            for manifest, content in originals.items():
+                write(os.path.join(main_dir, manifest), content)
+
+        def reset_cold():
+            reset_warm()
+            for cache in CACHES:
+                cache.clear()
+
+        os.chdir(main_dir)
+        results = [
+            measure(
+                "directories",
+                lambda: directories(top_dir, main_dir),
+                parsed_args.iterations,
+            )
+        ]
+        dirs = directories(top_dir, main_dir)
+        container_mode = parsed_args.container_mode
+        # process_python stops after pyproject.toml so time both files
+        processors = [
+            process_python_requirements,
+            process_python_pyproject,
+            process_javascript,
+            process_ansible,
+        ]
+        if shutil.which("go"):
+            processors.insert(0, process_golang)
+        else:
+            print("go not found, skipping process_golang", file=sys.stderr)
+        for processor in processors:
+            for temperature, reset in (("cold", reset_cold), ("warm", reset_warm)):
+                results.append(
+                    measure(
+                        f"{processor.__name__} ({temperature})",
+                        lambda: processor(main_dir, dirs, container_mode),
+                        parsed_args.iterations,
+                        reset,
+                    )
+                )
+    finally:
+        os.chdir(saved_cwd)
+        if not parsed_args.keep:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    print(
+        f"{'phase':<36} {'min (s)':>10} {'mean (s)':>10} {'peak (KiB)':>12} "
+        f"{'result':>8}"
+    )
+    for result in results:
+        print(
+            f"{result['phase']:<36} {result['min']:>10.3f} {result['mean']:>10.3f} "
+            f"{result['peak_kib']:>12} {result['result']!s:>8}"
+        )
+    children_maxrss = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    print(f"peak RSS of the subprocesses: {children_maxrss} KiB")
+    if parsed_args.json:
+        with open(parsed_args.json, "w", encoding="UTF-8") as out_stream:
+            json.dump(
+                {
+                    "repos": parsed_args.repos,
+                    "lines": parsed_args.lines,
+                    "container_mode": container_mode,
+                    "results": results,
+                    "children_maxrss_kib": children_maxrss,
+                },
+                out_stream,
+                indent=2,
+            )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
+
+# bench_stage3.py ends here
@@ -1,71 +1,432 @@
 "Ansible specific code for stage 3."
 
+import glob
 import os
+import shutil
+import subprocess
+import tempfile
 
 import yaml
 
-from depends_on.common import log
+from depends_on.common import command, log, write_if_changed
+from depends_on.trace import span, traced
+
+# the C implementation of the YAML parser is much faster when available
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# requirements files of the main project, relative to its directory
+REQUIREMENTS_FILES = (
+    "requirements.yml",
+    "requirements.yaml",
+    "collections/requirements.yml",
+    "collections/requirements.yaml",
+    "roles/requirements.yml",
+    "roles/requirements.yaml",
+    "meta/requirements.yml",
+    "meta/requirements.yaml",
+    "roles/*/meta/requirements.yml",
+    "roles/*/meta/requirements.yaml",
+)
+
+# cache of the collection and role names: {path: (stat of the files, names)}
+_NAME_CACHE = {}
+
+# tarballs of the local collections built during this run: {path: tarball}
+_TARBALLS = {}
+
+
+def load_yaml(fname):
+    "Load a YAML file with the fastest available loader."
+    with open(fname, "r", encoding="UTF-8") as in_stream:
+        return yaml.load(in_stream, Loader=Loader)
 
 
 def get_collection_name(repo_dir):
     "Return the collection name from the galaxy.yml file."
     if os.path.exists(os.path.join(repo_dir, "galaxy.yml")):
-        with open(
-            os.path.join(repo_dir, "galaxy.yml"), "r", encoding="UTF-8"
-        ) as in_stream:
-            data = yaml.safe_load(in_stream)
+        data = load_yaml(os.path.join(repo_dir, "galaxy.yml"))
+        try:
+            return data["namespace"] + "." + data["name"]
+        except KeyError:
+            pass
+    return None
+
+
+def get_role_name(repo_dir):
+    "Return the namespace.role_name of a role from its meta/main.yml file."
+    meta = os.path.join(repo_dir, "meta", "main.yml")
+    if os.path.exists(meta):
+        data = load_yaml(meta)
+        galaxy_info = data.get("galaxy_info") if isinstance(data, dict) else None
+        if isinstance(galaxy_info, dict) and "role_name" in galaxy_info:
+            if "namespace" in galaxy_info:
+                return f"{galaxy_info['namespace']}.{galaxy_info['role_name']}"
+            return galaxy_info["role_name"]
+    return None
+
+
+def get_names(repo_dir):
+    """Return the (collection name, role name) of a local dependency.
+
+    The names are cached until galaxy.yml or meta/main.yml changes.
+    """
+    key = []
+    for fname in ("galaxy.yml", os.path.join("meta", "main.yml")):
+        try:
+            stat = os.stat(os.path.join(repo_dir, fname))
+            key.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            key.append(None)
+    cached = _NAME_CACHE.get(repo_dir)
+    if cached and cached[0] == key:
+        return cached[1]
+    names = (
+        get_collection_name(repo_dir) if key[0] else None,
+        get_role_name(repo_dir) if key[1] else None,
+    )
+    _NAME_CACHE[repo_dir] = (key, names)
+    return names
+
+
+def get_ansible_index(dirs):
+    """Return the index of the local dependencies used to match the requirements.
+
+    {"collections": {collection name: info}, "roles": {role name: info},
+    "repos": {repository name: info}}
+    """
+    index = {"collections": {}, "roles": {}, "repos": {}}
+    for repo_name, info in dirs.items():
+        collection_name, role_name = get_names(info["path"])
+        if collection_name:
+            index["collections"][collection_name] = info
+        if role_name:
+            index["roles"][role_name] = info
+        index["repos"][repo_name] = info
+    return index
+
+
+def url_repo_name(url):
+    "Return the github.com/<org>/<repo> name of a git URL or None if it isn't a URL."
+    url = url.split(",", 1)[0]
+    if url.startswith("git+"):
+        url = url[4:]
+    if url.startswith("git@"):
+        url = "https://" + url[4:].replace(":", "/", 1)
+    if "://" not in url:
+        return None
+    if url.endswith(".git"):
+        url = url[:-4]
+    return "/".join(url.split("/")[2:5])
+
+
+def get_collection_cache_dir():
+    "Return the directory of the collection tarball cache or None if it is disabled."
+    cache_dir = os.environ.get("DEPENDS_ON_ANSIBLE_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    if os.environ.get("DEPENDS_ON_CACHE_DIR"):
+        return os.path.join(os.environ["DEPENDS_ON_CACHE_DIR"], "ansible")
+    return None
+
+
+def get_tree_hash(repo_dir):
+    """Return the tree hash of the checkout or None if it has local changes.
+
+    The depends-on.json file added by stage2 is not a local change.
+    """
+    with span("git rev-parse HEAD^{tree}", "git"):
+        ret = subprocess.run(
+            ["git", "rev-parse", "HEAD^{tree}"],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+        )
+        if ret.returncode != 0:
+            return None
+        status = subprocess.run(
+            ["git", "status", "--porcelain"],
+            cwd=repo_dir,
+            capture_output=True,
+            text=True,
+        )
+    # stage2 saves depends-on.json in the checkouts of the dependencies
+    changes = [
+        line for line in status.stdout.splitlines() if line != "?? depends-on.json"
+    ]
+    if status.returncode != 0 or changes:
+        log(f"{repo_dir} has local changes, not using the collection cache")
+        return None
+    return ret.stdout.strip()
+
+
+def get_collection_tarball(collection_name, repo_dir):
+    """Return the tarball of the collection built from repo_dir or None.
+
+    The tarballs are kept in the DEPENDS_ON_ANSIBLE_CACHE_DIR directory,
+    named after the tree hash of the checkout, so an unchanged collection
+    is only built once across runs.
+    """
+    if repo_dir in _TARBALLS:
+        return _TARBALLS[repo_dir]
+    tarball = None
+    cache_dir = get_collection_cache_dir()
+    tree_hash = get_tree_hash(repo_dir) if cache_dir else None
+    if tree_hash:
+        path = os.path.join(
+            os.path.abspath(cache_dir), f"{collection_name}-{tree_hash}.tar.gz"
+        )
+        if os.path.exists(path):
+            log(f"Using the cached build {path} of {collection_name}")
+            tarball = path
+        elif shutil.which("ansible-galaxy") is None:
+            log("ansible-galaxy not found, not building the collection")
+        else:
+            os.makedirs(cache_dir, exist_ok=True)
+            # build in a temporary directory of the cache to publish it atomically
+            build_dir = tempfile.mkdtemp(dir=cache_dir, prefix=".build.")
             try:
-                return data["namespace"] + "." + data["name"]
-            except KeyError:
-                pass
+                ret = command(
+                    [
+                        "ansible-galaxy",
+                        "collection",
+                        "build",
+                        "--output-path",
+                        build_dir,
+                        repo_dir,
+                    ],
+                    check=False,
+                )
+                builds = glob.glob(os.path.join(build_dir, "*.tar.gz"))
+                if ret == 0 and len(builds) == 1:
+                    os.replace(builds[0], path)
+                    tarball = path
+                else:
+                    log(f"Unable to build {collection_name} from {repo_dir}")
+            finally:
+                shutil.rmtree(build_dir, ignore_errors=True)
+    _TARBALLS[repo_dir] = tarball
+    return tarball
+
+
+def collection_requirement(collection_name, info, container_mode):
+    "Return the requirement of a collection installed from the local dependency."
+    if container_mode:
+        return {"name": info["fork_url"], "version": info["branch"], "type": "git"}
+    tarball = get_collection_tarball(collection_name, info["path"])
+    if tarball:
+        return {"name": tarball, "type": "file"}
+    return {"name": collection_name, "source": info["path"], "type": "dir"}
+
+
+def role_requirement(role_name, info, container_mode):
+    "Return the requirement of a role installed from the local dependency."
+    requirement = {"name": role_name} if role_name else {}
+    if container_mode:
+        requirement.update(src=f"git+{info['fork_url']}", version=info["branch"])
+    else:
+        requirement.update(src=f"git+file://{info['path']}")
+    return requirement
+
+
+def scalar_value(node, key):
+    "Return the value of key in a mapping node or None."
+    for key_node, value_node in node.value:
+        if key_node.value == key and isinstance(value_node, yaml.ScalarNode):
+            return value_node.value
+    return None
+
+
+def match_collection(node, index, container_mode):
+    "Return the replacement of a collections item node or None."
+    if isinstance(node, yaml.ScalarNode):
+        name = node.value
+    elif isinstance(node, yaml.MappingNode):
+        name = scalar_value(node, "name") or scalar_value(node, "source")
+    else:
+        return None
+    if not name:
+        return None
+    if name in index["collections"]:
+        return collection_requirement(name, index["collections"][name], container_mode)
+    repo_name = url_repo_name(name)
+    info = index["repos"].get(repo_name)
+    if info is not None:
+        collection_name = get_names(info["path"])[0]
+        if collection_name:
+            return collection_requirement(collection_name, info, container_mode)
+    return None
+
+
+def match_role(node, index, container_mode):
+    "Return the replacement of a roles item node or None."
+    if isinstance(node, yaml.ScalarNode):
+        name, src = None, node.value
+    elif isinstance(node, yaml.MappingNode):
+        name, src = scalar_value(node, "name"), scalar_value(node, "src")
+    else:
+        return None
+    for role in (src, name):
+        if role and role in index["roles"]:
+            return role_requirement(name or role, index["roles"][role], container_mode)
+    info = index["repos"].get(url_repo_name(src)) if src else None
+    if info is not None:
+        return role_requirement(name, info, container_mode)
     return None
 
 
-def substitute_collection(collection_name, info, requirements, container_mode):
-    "Substitute the collection into the requirements."
-    if collection_name is None or "collections" not in requirements:
-        return 0
-    for idx in range(len(requirements["collections"])):
-        data = requirements["collections"][idx]
-        if data == collection_name or (
-            "name" in data and data["name"] == collection_name
-        ):
-            if container_mode:
-                requirements["collections"][idx] = {
-                    "name": info["fork_url"],
-                    "version": info["branch"],
-                    "type": "git",
-                }
+def scalar_ranges(node, line_starts):
+    "Return the (start, end) offsets of the scalars of a node and its children."
+    if isinstance(node, yaml.ScalarNode):
+        return [
+            (
+                line_starts[node.start_mark.line] + node.start_mark.column,
+                line_starts[node.end_mark.line] + node.end_mark.column,
+            )
+        ]
+    if isinstance(node, yaml.MappingNode):
+        children = [child for pair in node.value for child in pair]
+    else:
+        children = node.value
+    return [
+        scalar_range
+        for child in children
+        for scalar_range in scalar_ranges(child, line_starts)
+    ]
+
+
+def inner_comments(content, start, end, node, line_starts):
+    "Return the comments from start to the line of end, outside the scalars of node."
+    ranges = scalar_ranges(node, line_starts)
+    comments = []
+    for line in range(node.start_mark.line, content.count("\n", 0, end)):
+        pos = max(start, line_starts[line])
+        line_end = line_starts[line + 1]
+        while True:
+            pos = content.find("#", pos, line_end)
+            if pos == -1:
+                break
+            # a comment starts a line or follows a space, outside the strings
+            if (pos == line_starts[line] or content[pos - 1] in " \t") and not any(
+                first <= pos < last for first, last in ranges
+            ):
+                comments.append(content[pos:line_end].rstrip("\r\n"))
+                break
+            pos += 1
+    return comments
+
+
+def flow_yaml(data):
+    "Return data as a one line YAML flow mapping."
+    return yaml.safe_dump(
+        data, default_flow_style=True, sort_keys=False, width=float("inf")
+    ).strip()
+
+
+def rewrite_requirements(content, index, container_mode):
+    """Rewrite the requirements of the local dependencies in a requirements.yml content.
+
+    The content is composed into YAML nodes to find the position of the
+    collections and roles items to replace. Only these items are changed,
+    keeping the comments and the layout of the rest of the file. The
+    comments inside a replaced item are moved on their own lines after it.
+
+    Returns the new content, the number of replacements and the list of the
+    role files to include.
+    """
+    root = yaml.compose(content, Loader=Loader)
+    if root is None:
+        return content, 0, []
+    sections = []
+    if isinstance(root, yaml.SequenceNode):
+        # roles only format
+        sections.append(("roles", root))
+    elif isinstance(root, yaml.MappingNode):
+        for key_node, value_node in root.value:
+            if key_node.value in ("roles", "collections") and isinstance(
+                value_node, yaml.SequenceNode
+            ):
+                sections.append((key_node.value, value_node))
+    line_starts = [0]
+    for line in content.splitlines(keepends=True):
+        line_starts.append(line_starts[-1] + len(line))
+    replacements = []
+    includes = []
+    for section, sequence in sections:
+        for node in sequence.value:
+            if isinstance(node, yaml.MappingNode) and scalar_value(node, "include"):
+                includes.append(scalar_value(node, "include"))
+                continue
+            if section == "collections":
+                requirement = match_collection(node, index, container_mode)
+            else:
+                requirement = match_role(node, index, container_mode)
+            if requirement is None:
+                continue
+            # the end mark of a block mapping is after the following comments
+            if isinstance(node, yaml.MappingNode) and not node.flow_style:
+                last = node.value[-1][1]
             else:
-                requirements["collections"][idx] = {
-                    "name": collection_name,
-                    "source": info["path"],
-                    "type": "dir",
-                }
-            log(f"Substituted {requirements['collections'][idx]} in requirements.yml")
-            return 1
-    return 0
+                last = node
+            start = line_starts[node.start_mark.line] + node.start_mark.column
+            end = line_starts[last.end_mark.line] + last.end_mark.column
+            text = flow_yaml(requirement)
+            comments = inner_comments(content, start, end, node, line_starts)
+            if comments:
+                # keep the end of the last line then add the comments after it
+                line_end = line_starts[last.end_mark.line + 1]
+                tail = content[end:line_end]
+                if not tail.endswith("\n"):
+                    tail += "\n"
+                indent = " " * node.start_mark.column
+                text += tail + "".join(f"{indent}{c}\n" for c in comments)
+                end = line_end
+            replacements.append((start, end, text))
+            log(f"Substituted {requirement} in {section}")
+    for start, end, text in reversed(replacements):
+        content = content[:start] + text + content[end:]
+    return content, len(replacements), includes
+
 
+def requirements_files(main_dir):
+    "Return the requirements files of the main project."
+    fnames = []
+    for pattern in REQUIREMENTS_FILES:
+        fnames += sorted(glob.glob(os.path.join(main_dir, pattern)))
+    return fnames
 
+
+@traced("processor")
 def process_ansible(main_dir, dirs, container_mode):
-    "Change the requirements.yml file to add the dependencies."
-    requirements_yml = os.path.join(main_dir, "requirements.yml")
-    if not os.path.exists(requirements_yml):
+    """Change the requirements files to use the dependencies.
+
+    The collections and roles of the local dependencies are replaced in the
+    requirements.yml files of the project, following their includes, without
+    changing the rest of the files.
+    """
+    fnames = requirements_files(main_dir)
+    if not fnames:
         return False
-    log(f"Processing {requirements_yml}")
-    with open(requirements_yml, "r", encoding="UTF-8") as in_stream:
-        requirements = yaml.safe_load(in_stream)
-    # add the dependencies from dirs
+    index = get_ansible_index(dirs)
+    real_main_dir = os.path.realpath(main_dir)
+    visited = set()
     nb_replace = 0
-    for _, info in dirs.items():
-        collection_name = get_collection_name(info["path"])
-        nb_replace += substitute_collection(
-            collection_name, info, requirements, container_mode
-        )
-    # if there is a change to requirements.yml, write it back
-    if nb_replace > 0:
-        with open(requirements_yml, "w", encoding="UTF-8") as out_stream:
-            yaml.dump(requirements, out_stream)
+    while fnames:
+        fname = os.path.realpath(fnames.pop(0))
+        if fname in visited or not os.path.exists(fname):
+            continue
+        visited.add(fname)
+        log(f"Processing {fname}")
+        with open(fname, "r", encoding="UTF-8") as in_stream:
+            content = in_stream.read()
+        content, count, includes = rewrite_requirements(content, index, container_mode)
+        for include in includes:
+            include = os.path.join(os.path.dirname(fname), include)
+            # only the files of the project are changed
+            if os.path.realpath(include).startswith(real_main_dir + os.sep):
+                fnames.append(include)
+        if count > 0:
+            write_if_changed(fname, content)
+            nb_replace += count
     return nb_replace > 0
 
 
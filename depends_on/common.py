@@ -1,16 +1,55 @@
 "Functions used by multiple stages."
 
+import contextlib
+import hashlib
 import json
 import os
 import re
 import shlex
+import shutil
 import subprocess
 import sys
+import tempfile
+import threading
 import urllib.parse
-from urllib.request import Request, urlopen
+from concurrent.futures import ThreadPoolExecutor
+from urllib.error import HTTPError
+from urllib.request import Request
+
+from depends_on import http_cache
+from depends_on.http_pool import urlopen
+from depends_on.trace import span
 
 _SENSITIVE_STRINGS = []
 
+# per thread list of log messages when the logs are buffered
+_LOG_BUFFER = threading.local()
+
+# serialize the changes to the global git configuration between workers
+_GIT_CONFIG_LOCK = threading.Lock()
+
+# content of the URLs already fetched during this run
+_URL_CONTENTS = {}
+
+# Pull request information prefetched with GraphQL by (org, repo, pr_number)
+_PULL_REQUEST_INFO = {}
+
+_GRAPHQL_PULL_REQUEST_FRAGMENT = """
+fragment pr on PullRequest {
+  merged
+  body
+  headRefName
+  baseRefName
+  headRepository { url }
+  baseRepository { url }
+}
+"""
+
+# mirrors of the clone cache already refreshed during this run and their locks
+_MIRRORS_REFRESHED = set()
+_MIRROR_LOCKS = {}
+_MIRROR_LOCKS_LOCK = threading.Lock()
+
 
 def add_sensitive_string(string):
     "Add a string to the list of sensitive strings."
@@ -24,22 +63,120 @@ def init_sensitive_strings():
         add_sensitive_string(os.environ.get(env_var))
 
 
-def log(message):
-    "Log a message to stderr after masking sensitive strings."
+def mask(message):
+    "Return the message with the sensitive strings masked."
     for sensitive_string in _SENSITIVE_STRINGS:
         message = message.replace(sensitive_string, "***")
-    print(message, file=sys.stderr)
+    return message
+
+
+def log(message):
+    "Log a message to stderr after masking sensitive strings."
+    message = mask(message)
+    lines = getattr(_LOG_BUFFER, "lines", None)
+    if lines is not None:
+        lines.append(message)
+    else:
+        print(message, file=sys.stderr)
+
+
+@contextlib.contextmanager
+def buffered_log(lines):
+    "Collect the log messages of the current thread into lines instead of printing them."
+    _LOG_BUFFER.lines = lines
+    try:
+        yield lines
+    finally:
+        _LOG_BUFFER.lines = None
+
+
+def flush_log(lines):
+    "Print log messages collected by buffered_log."
+    for line in lines:
+        print(line, file=sys.stderr)
+
+
+def get_http_cache_dir():
+    "Return the directory of the HTTP response cache or None if it is disabled."
+    cache_dir = os.environ.get("DEPENDS_ON_HTTP_CACHE_DIR")
+    if cache_dir:
+        return cache_dir
+    if os.environ.get("DEPENDS_ON_CACHE_DIR"):
+        return os.path.join(os.environ["DEPENDS_ON_CACHE_DIR"], "http")
+    return None
+
+
+def get_url(url, **headers):
+    """Get the content of an URL as a string.
+
+    When the response cache is enabled, a cached response younger than
+    DEPENDS_ON_HTTP_CACHE_TTL seconds is used as is, an older one is
+    revalidated with If-None-Match/If-Modified-Since. An URL is fetched only
+    once per run.
+    """
+    key = http_cache.cache_key(url, headers)
+    if key in _URL_CONTENTS:
+        return _URL_CONTENTS[key]
+    cache_dir = get_http_cache_dir()
+    entry = None
+    if cache_dir:
+        entry = http_cache.load(cache_dir, key)
+        if entry and http_cache.is_fresh(
+            entry, float(os.environ.get("DEPENDS_ON_HTTP_CACHE_TTL", "0"))
+        ):
+            log(f"Using cached response for {url}")
+            _URL_CONTENTS[key] = entry["body"]
+            return entry["body"]
+    req = Request(url)
+    for header, value in headers.items():
+        req.add_header(header, value)
+    if entry:
+        if entry["etag"]:
+            req.add_header("If-None-Match", entry["etag"])
+        if entry["last_modified"]:
+            req.add_header("If-Modified-Since", entry["last_modified"])
+    try:
+        with span(f"GET {url}", "http"), urlopen(req) as response:
+            response_content = response.read().decode("utf-8")
+            response_headers = response.headers
+    except HTTPError as exc:
+        if exc.code != 304 or not entry:
+            raise
+        log(f"Cached response for {url} not modified")
+        response_content = entry["body"]
+        response_headers = exc.headers
+    if cache_dir:
+        http_cache.store(
+            cache_dir,
+            key,
+            url,
+            response_content,
+            etag=response_headers.get("ETag") or (entry and entry["etag"]),
+            last_modified=response_headers.get("Last-Modified")
+            or (entry and entry["last_modified"]),
+        )
+        http_cache.evict(
+            cache_dir,
+            int(os.environ.get("DEPENDS_ON_HTTP_CACHE_SIZE", "64")) * 1024 * 1024,
+        )
+    _URL_CONTENTS[key] = response_content
+    return response_content
 
 
 def get_json_url(url, **headers):
     "Get the content of an URL."
-    req = Request(url)
+    return json.loads(get_url(url, **headers))
+
+
+def post_json_url(url, data, **headers):
+    "Post data as JSON to an URL and return the decoded JSON answer."
+    req = Request(url, data=json.dumps(data).encode("utf-8"), method="POST")
+    req.add_header("Content-Type", "application/json")
     for header, value in headers.items():
         req.add_header(header, value)
-    with urlopen(req) as response:
+    with span(f"POST {url}", "http"), urlopen(req) as response:
         response_content = response.read()
-    response_content.decode("utf-8")
-    return json.loads(response_content)
+    return json.loads(response_content.decode("utf-8"))
 
 
 def save_depends_on(data, dirname):
@@ -54,8 +191,45 @@ def save_depends_on(data, dirname):
         json.dump(data, json_stream, indent=2)
 
 
+def write_if_changed(fname, content):
+    """Atomically replace the content of fname if it differs.
+
+    The content is written to a temporary file in the same directory which
+    is renamed over fname, keeping its permissions. Nothing is written when
+    fname already has this content so its mtime is kept.
+
+    Returns True if fname was written.
+    """
+    data = content.encode("UTF-8") if isinstance(content, str) else content
+    try:
+        with open(fname, "rb") as in_stream:
+            if in_stream.read() == data:
+                log(f"{fname} unchanged")
+                return False
+        mode = os.stat(fname).st_mode & 0o7777
+    except FileNotFoundError:
+        mode = 0o644
+    fd, tmp_fname = tempfile.mkstemp(
+        dir=os.path.dirname(fname) or ".", prefix=f".{os.path.basename(fname)}."
+    )
+    try:
+        with os.fdopen(fd, "wb") as out_stream:
+            out_stream.write(data)
+        os.chmod(tmp_fname, mode)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        os.unlink(tmp_fname)
+        raise
+    log(f"Wrote {fname}")
+    return True
+
+
 def get_pull_request_info(org, repo, pr_number):
     "Get the information about a GitHub Pull request."
+    pr_info = _PULL_REQUEST_INFO.get((org, repo, str(pr_number)))
+    if pr_info:
+        log(f"Using prefetched information for {org}/{repo}#{pr_number}")
+        return pr_info
     token = os.environ.get("GITHUB_TOKEN")
     # get the information about the Pull request using the GitHub API
     # set the Authorization header to use the token
@@ -69,23 +243,90 @@ def get_pull_request_info(org, repo, pr_number):
     return pr_info
 
 
+def prefetch_pull_requests_info(depends_on_urls):
+    """Fetch the information of all the GitHub Pull requests in one GraphQL query.
+
+    The results are then used by get_pull_request_info. The GraphQL API needs a
+    token. On error, nothing is prefetched and get_pull_request_info falls back
+    to one REST call per Pull request. Return the number of prefetched Pull requests.
+    """
+    token = os.environ.get("GITHUB_TOKEN")
+    if not token:
+        return 0
+    pull_requests = []
+    for depends_on_url in depends_on_urls:
+        if is_gerrit(depends_on_url) or is_gitlab(depends_on_url):
+            continue
+        try:
+            org, repo, pr_number, _ = parse_pull_request_url(depends_on_url)
+        except ValueError:
+            continue
+        key = (org, repo, pr_number)
+        if (
+            pr_number.isdigit()
+            and key not in pull_requests
+            and key not in _PULL_REQUEST_INFO
+        ):
+            pull_requests.append(key)
+    if len(pull_requests) == 0:
+        return 0
+    query = _GRAPHQL_PULL_REQUEST_FRAGMENT + "query {\n"
+    for idx, (org, repo, pr_number) in enumerate(pull_requests):
+        query += (
+            f"  pr{idx}: repository(owner: {json.dumps(org)}, name: {json.dumps(repo)}) "
+            f"{{ pullRequest(number: {pr_number}) {{ ...pr }} }}\n"
+        )
+    query += "}\n"
+    log(f"Fetching {len(pull_requests)} Pull requests with GraphQL")
+    try:
+        result = post_json_url(
+            "https://api.github.com/graphql",
+            {"query": query},
+            Authorization=f"bearer {token}",
+        )
+    except (OSError, ValueError) as exc:
+        log(f"GraphQL query failed, using the REST API: {exc}")
+        return 0
+    if result.get("errors"):
+        log(f"GraphQL errors: {result['errors']}")
+    data = result.get("data") or {}
+    nb_prefetched = 0
+    for idx, key in enumerate(pull_requests):
+        pr = (data.get(f"pr{idx}") or {}).get("pullRequest")
+        # deleted forks have no head repository: use the REST API for them
+        if not pr or not pr["headRepository"] or not pr["baseRepository"]:
+            continue
+        # same layout as the REST API answer
+        _PULL_REQUEST_INFO[key] = {
+            "merged": pr["merged"],
+            "body": pr["body"],
+            "head": {
+                "ref": pr["headRefName"],
+                "repo": {"clone_url": pr["headRepository"]["url"] + ".git"},
+            },
+            "base": {
+                "ref": pr["baseRefName"],
+                "repo": {"clone_url": pr["baseRepository"]["url"] + ".git"},
+            },
+        }
+        nb_prefetched += 1
+    return nb_prefetched
+
+
 def get_gerrit_change_info(gerrit_url, gerrit_change_id):
     "Get the information about the Gerrit change."
-    req = Request(
+    response_content = get_url(
         f"{gerrit_url}/changes/{gerrit_change_id}?o=CURRENT_REVISION&o=CURRENT_COMMIT",
+        Accept="application/json",
     )
-    req.add_header("Accept", "application/json")
-    with urlopen(req) as response:
-        response_content = response.read()
     # remove the magic prefix
-    response_content = re.sub(r"^\)\]\}\'\n", "", response_content.decode("utf-8"))
+    response_content = re.sub(r"^\)\]\}\'\n", "", response_content)
     change_info = json.loads(response_content)
     return change_info
 
 
-def extract_pull_request(depends_on_url, check_mode, extra_dirs):
-    "Extract the dependency by git cloning the repository in the right branch for the Pull request."
-    # parse the URL to extract the repo, org and pr number
+def parse_pull_request_url(depends_on_url):
+    "Return the org, repo, pr number and parameters of a GitHub Pull request URL."
     # the format is https://github.com/<org>/<repo>/pull/<pr_number>?subdir=<subdir>&<key>=<value>
     url_parts = depends_on_url.split("/")
     if len(url_parts) != 7:
@@ -99,6 +340,13 @@ def extract_pull_request(depends_on_url, check_mode, extra_dirs):
         pr_data = {x.split("=")[0]: x.split("=")[1] for x in pr_data}
     else:
         pr_data = {}
+    return org, repo, pr_number, pr_data
+
+
+def extract_pull_request(depends_on_url, check_mode, extra_dirs):
+    "Extract the dependency by git cloning the repository in the right branch for the Pull request."
+    # parse the URL to extract the repo, org and pr number
+    org, repo, pr_number, pr_data = parse_pull_request_url(depends_on_url)
     pr_info = get_pull_request_info(org, repo, pr_number)
     top_dir = os.path.realpath(repo)
 
@@ -108,6 +356,7 @@ def extract_pull_request(depends_on_url, check_mode, extra_dirs):
             main_url=pr_info["base"]["repo"]["clone_url"],
             pr_number=pr_number,
             repo=repo,
+            subdir=pr_data.get("subdir"),
         )
 
         # save the information about the Pull request in depends-on.json
@@ -130,7 +379,10 @@ def extract_pull_request(depends_on_url, check_mode, extra_dirs):
         save_depends_on(data, repo)
         log(f"PR data: {data}")
         return pr_info["merged"], data
-    return pr_info["merged"], {}
+    return pr_info["merged"], {
+        "description": pr_info["body"],
+        "change_url": depends_on_url,
+    }
 
 
 def extract_gerrit_review(depends_on_url, check_mode, extra_dirs):
@@ -185,7 +437,12 @@ def extract_gerrit_review(depends_on_url, check_mode, extra_dirs):
         save_depends_on(data, project)
         log(f"Change data: {data}")
         return change_info["status"] == "MERGED", data
-    return change_info["status"] == "MERGED", {}
+    return change_info["status"] == "MERGED", {
+        "description": change_info["revisions"][change_info["current_revision"]][
+            "commit"
+        ]["message"],
+        "change_url": depends_on_url,
+    }
 
 
 def get_gitlab_project_info(gitlab_url, project, headers):
@@ -265,7 +522,10 @@ def extract_gitlab_merge_request(depends_on_url, check_mode, extra_dirs):
         save_depends_on(data, base_project)
         log(f"Change data: {data}")
         return mr_info["state"] == "merged", data
-    return mr_info["state"] == "merged", {}
+    return mr_info["state"] == "merged", {
+        "description": mr_info["description"],
+        "change_url": depends_on_url,
+    }
 
 
 def extract_depends_on(depends_on_url, check_mode, extra_dirs):
@@ -278,10 +538,306 @@ def extract_depends_on(depends_on_url, check_mode, extra_dirs):
         return extract_pull_request(depends_on_url, check_mode, extra_dirs)
 
 
-def clone_repo(base_url, repo):
-    "Clone a git repository if the target directory doesn't exist."
-    if not os.path.isdir(repo):
-        command(["git", "clone", "--filter=tree:0", base_url, repo])
+def get_depends_on_urls(description):
+    "Return the list of URLs from the Depends-On: lines of a description."
+    return [
+        u.strip().rstrip("\r")
+        for u in re.findall(
+            r"^Depends-On: (.*)",
+            description or "",
+            re.IGNORECASE | re.MULTILINE,
+        )
+    ]
+
+
+def canonical_change_url(change_url):
+    "Return the URL identifying a change: without parameters, fragment nor trailing slash."
+    url_parts = urllib.parse.urlsplit(change_url.strip())
+    return urllib.parse.urlunsplit(
+        (
+            url_parts.scheme.lower(),
+            url_parts.netloc.lower(),
+            url_parts.path.rstrip("/"),
+            "",
+            "",
+        )
+    )
+
+
+def strip_trailing_slash(change_url):
+    "Return the change URL without trailing slash in its path, keeping its parameters."
+    url_parts = urllib.parse.urlsplit(change_url.strip())
+    return urllib.parse.urlunsplit(url_parts._replace(path=url_parts.path.rstrip("/")))
+
+
+def format_depends_on_graph(graph):
+    "Return a readable dump of a Depends-On graph."
+    lines = ["Depends-On graph:"]
+    for change_url, deps in graph.items():
+        lines.append(f"  {change_url} -> {', '.join(deps) if deps else '(none)'}")
+    return "\n".join(lines)
+
+
+def sort_depends_on_graph(graph):
+    """Return the changes of the graph, dependencies first, or exit if there is a cycle.
+
+    The order of the Depends-On lines is kept when there is no constraint.
+    """
+    order = []
+    # 1: being visited, 2: done
+    state = {}
+    for root in graph:
+        if root in state:
+            continue
+        # iterative depth first search to not hit the recursion limit
+        path = [root]
+        state[root] = 1
+        stack = [iter(graph[root])]
+        while stack:
+            dep = next(stack[-1], None)
+            if dep is None:
+                stack.pop()
+                done = path.pop()
+                state[done] = 2
+                order.append(done)
+            elif state.get(dep) == 1:
+                cycle = path[path.index(dep) :] + [dep]
+                log(format_depends_on_graph(graph))
+                check_error(False, f"Depends-On cycle: {' -> '.join(cycle)}")
+            elif dep not in state:
+                state[dep] = 1
+                path.append(dep)
+                stack.append(iter(graph.get(dep, [])))
+    return order
+
+
+def resolve_depends_on_graph(change_url, depends_on_urls, extra_dirs):
+    """Return all the changes needed by a change, dependencies first.
+
+    The Depends-On graph is walked breadth first from the depends_on_urls of
+    the change at change_url. The description of each change is fetched once
+    and the changes are identified by their canonical URL. The dependencies of
+    merged changes are not followed. The dependencies back to the change
+    itself are satisfied by its checkout, so mutually dependent changes are
+    accepted. Exit with a dump of the graph on cycles between the other
+    changes.
+    """
+    root = canonical_change_url(change_url)
+    graph = {root: [canonical_change_url(u) for u in depends_on_urls]}
+    urls = {}
+    # the URL parsers do not accept a trailing slash
+    level = [strip_trailing_slash(u) for u in depends_on_urls]
+    while level:
+        # fetch all the GitHub Pull requests of this level in one call
+        prefetch_pull_requests_info(level)
+        next_level = []
+        for depends_on_url in level:
+            key = canonical_change_url(depends_on_url)
+            if key in graph:
+                continue
+            urls[key] = depends_on_url
+            merged, info = extract_depends_on(depends_on_url, True, extra_dirs)
+            if merged:
+                graph[key] = []
+                continue
+            deps = get_depends_on_urls(filter_comments(info).get("description"))
+            # the change under test is already checked out
+            deps = [u for u in deps if canonical_change_url(u) != root]
+            graph[key] = [canonical_change_url(u) for u in deps]
+            next_level.extend(strip_trailing_slash(u) for u in deps)
+        level = next_level
+    if len(urls) > len(depends_on_urls):
+        log(format_depends_on_graph(graph))
+    return [urls[key] for key in sort_depends_on_graph(graph) if key != root]
+
+
+def get_target_dir(depends_on_url):
+    "Guess the directory where a dependency will be extracted from its URL."
+    if is_gerrit(depends_on_url):
+        # https://<server>/c/<project>/+/<number>: the project is not always in the URL
+        gerrit_url, change = depends_on_url.split("/c/", 1)
+        project = change.split("/+/")
+        if len(project) == 2 and project[0]:
+            return os.path.basename(project[0])
+        # the directory is named after the project of the change like in extract_gerrit_review
+        try:
+            change_info = get_gerrit_change_info(gerrit_url, change.split("/")[-1])
+            return os.path.basename(change_info["project"])
+        except Exception:
+            return depends_on_url
+    if is_gitlab(depends_on_url):
+        return os.path.basename(depends_on_url.split("/-/merge_requests/")[0])
+    url_parts = depends_on_url.split("/")
+    return url_parts[4] if len(url_parts) > 4 else depends_on_url
+
+
+def _extract_depends_on_group(depends_on_urls, check_mode, extra_dirs):
+    "Extract sequentially dependencies sharing the same directory, buffering the logs."
+    outcomes = []
+    for depends_on_url in depends_on_urls:
+        lines = []
+        with buffered_log(lines):
+            try:
+                result = extract_depends_on(depends_on_url, check_mode, extra_dirs)
+            # BaseException to also report sys.exit() from check_error
+            except BaseException as exc:
+                outcomes.append((lines, None, exc))
+                break
+        outcomes.append((lines, result, None))
+    return outcomes
+
+
+def extract_depends_on_all(depends_on_urls, check_mode, extra_dirs, jobs=1):
+    """Extract all the dependencies using up to jobs parallel workers.
+
+    Dependencies extracted in the same directory are processed in order by the
+    same worker. The log messages of each dependency are printed together and
+    the results are returned in the order of depends_on_urls. The first failure,
+    in that order, is raised like in the serial case.
+    """
+    if jobs <= 1 or len(depends_on_urls) <= 1:
+        return [
+            extract_depends_on(depends_on_url, check_mode, extra_dirs)
+            for depends_on_url in depends_on_urls
+        ]
+    groups = {}
+    for depends_on_url in depends_on_urls:
+        groups.setdefault(get_target_dir(depends_on_url), []).append(depends_on_url)
+    log(f"Extracting {len(depends_on_urls)} dependencies with {jobs} workers")
+    results = []
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            target_dir: executor.submit(
+                _extract_depends_on_group, urls, check_mode, extra_dirs
+            )
+            for target_dir, urls in groups.items()
+        }
+        positions = dict.fromkeys(groups, 0)
+        try:
+            for depends_on_url in depends_on_urls:
+                target_dir = get_target_dir(depends_on_url)
+                lines, result, exc = futures[target_dir].result()[positions[target_dir]]
+                positions[target_dir] += 1
+                flush_log(lines)
+                if exc is not None:
+                    raise exc
+                results.append(result)
+        finally:
+            # do not start new extractions after a failure
+            for future in futures.values():
+                future.cancel()
+    return results
+
+
+def get_mirror_dir(cache_dir, base_url):
+    "Return the directory of the bare mirror of base_url in cache_dir."
+    url_parts = urllib.parse.urlsplit(base_url)
+    if url_parts.netloc:
+        # credentials are not part of the identity of the repository
+        key = url_parts.netloc.rsplit("@", 1)[-1] + url_parts.path
+    else:
+        key = base_url
+    key = key.rstrip("/")
+    if key.endswith(".git"):
+        key = key[:-4]
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    return os.path.join(cache_dir, f"{os.path.basename(key)}-{digest}.git")
+
+
+def fetch_mirror(base_url, mirror):
+    "Fetch the branches and tags of base_url into the bare mirror."
+    # the URL is passed on the command line to avoid storing credentials in the cache
+    return (
+        command(
+            [
+                "git",
+                "fetch",
+                "--prune",
+                "--quiet",
+                base_url,
+                "+refs/heads/*:refs/heads/*",
+                "+refs/tags/*:refs/tags/*",
+            ],
+            cwd=mirror,
+            check=False,
+        )
+        == 0
+    )
+
+
+def update_mirror(base_url):
+    """Create or refresh the mirror of base_url in the DEPENDS_ON_CACHE_DIR directory.
+
+    The mirror is fetched at most once per run. Return the path of the mirror or
+    None if the cache is disabled or the mirror cannot be updated.
+    """
+    cache_dir = os.environ.get("DEPENDS_ON_CACHE_DIR")
+    if not cache_dir:
+        return None
+    mirror = get_mirror_dir(cache_dir, base_url)
+    with _MIRROR_LOCKS_LOCK:
+        mirror_lock = _MIRROR_LOCKS.setdefault(mirror, threading.Lock())
+    with mirror_lock:
+        if mirror in _MIRRORS_REFRESHED:
+            return mirror
+        if os.path.isdir(mirror):
+            log(f"Refreshing mirror {mirror}")
+            if not fetch_mirror(base_url, mirror):
+                return None
+        else:
+            log(f"Creating mirror {mirror}")
+            os.makedirs(cache_dir, exist_ok=True)
+            # populate a temporary directory to never expose a partial mirror
+            tmp_mirror = tempfile.mkdtemp(prefix=".tmp-", dir=cache_dir)
+            command(["git", "init", "--quiet", "--bare", tmp_mirror])
+            if not fetch_mirror(base_url, tmp_mirror):
+                shutil.rmtree(tmp_mirror, ignore_errors=True)
+                return None
+            try:
+                os.rename(tmp_mirror, mirror)
+            except OSError:
+                # another job created the mirror in the meantime
+                shutil.rmtree(tmp_mirror, ignore_errors=True)
+        _MIRRORS_REFRESHED.add(mirror)
+    return mirror
+
+
+def clone_repo(base_url, repo, subdir=None):
+    """Clone a git repository if the target directory doesn't exist.
+
+    When subdir is set, only subdir and the files at the top of the repository
+    are checked out (cone mode sparse checkout).
+    """
+    if os.path.isdir(repo):
+        sparse = subprocess.run(
+            ["git", "config", "--bool", "core.sparseCheckout"],
+            cwd=repo,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        if sparse == "true":
+            # another change of the same repository can need another subdir
+            # or the full tree
+            if subdir:
+                command(["git", "sparse-checkout", "add", subdir], cwd=repo)
+            else:
+                command(["git", "sparse-checkout", "disable"], cwd=repo)
+        return
+    mirror = update_mirror(base_url)
+    if mirror:
+        # borrow the objects of the mirror through objects/info/alternates
+        # instead of copying them: the mirror outlives the job
+        cmd = ["git", "clone", "--reference", mirror]
+    elif subdir:
+        # blobs are only downloaded for the checked out files
+        cmd = ["git", "clone", "--filter=blob:none"]
+    else:
+        cmd = ["git", "clone", "--filter=tree:0"]
+    if subdir:
+        cmd.append("--sparse")
+    command(cmd + [base_url, repo])
+    if subdir:
+        command(["git", "sparse-checkout", "set", "--cone", subdir], cwd=repo)
 
 
 def extract_gitlab_change(base_url, change_url, branch, main_branch, repo):
@@ -294,9 +850,11 @@ def extract_gitlab_change(base_url, change_url, branch, main_branch, repo):
     return repo
 
 
-def extract_github_change(main_url, pr_number, repo, fork_url=None, branch=None):
+def extract_github_change(
+    main_url, pr_number, repo, fork_url=None, branch=None, subdir=None
+):
     "Extract the dependency by git cloning the repository in the right branch for the Pull request."
-    clone_repo(main_url, repo)
+    clone_repo(main_url, repo, subdir)
     if fork_url and branch:
         command(["git", "remote", "add", "fork", fork_url], cwd=repo)
         command(["git", "fetch", "fork", branch], cwd=repo)
@@ -322,24 +880,90 @@ def extract_gerrit_change(change_url, branch, main_branch, repo):
 def unshallow(repo, branch):
     "Convert a shallow clone into a full clone."
     # --unshallow fails on non-shallow clones, which is expected
-    log(f"+ {shlex.join(['git', 'fetch', '--unshallow', 'origin', branch])}")
-    subprocess.run(["git", "fetch", "--unshallow", "origin", branch], cwd=repo)
+    cmd = ["git", "fetch", "--unshallow", "origin", branch]
+    log(f"+ {shlex.join(cmd)}")
+    with span(shlex.join(cmd), "git"):
+        subprocess.run(cmd, cwd=repo)
+    return repo
+
+
+def git_succeeds(cmd, repo):
+    "Return True if the git command succeeds in repo, its output is not shown."
+    with span(shlex.join(["git"] + cmd), "git"):
+        return (
+            subprocess.run(
+                ["git"] + cmd,
+                cwd=repo,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            ).returncode
+            == 0
+        )
+
+
+def is_shallow(repo):
+    "Return True if repo is a shallow clone."
+    return (
+        subprocess.run(
+            ["git", "rev-parse", "--is-shallow-repository"],
+            cwd=repo,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+        == "true"
+    )
+
+
+def fetch_main_branch(repo, main_branch):
+    """Fetch main_branch as origin_<main_branch> with enough history to merge it.
+
+    On shallow clones, the history of HEAD and of the main branch is deepened
+    by DEPENDS_ON_DEEPEN_STEP commits, doubling at each round, until a merge
+    base is found. The clone is fully unshallowed when more than
+    DEPENDS_ON_MAX_DEEPEN commits would be needed or when deepening fails.
+    """
+    refspec = f"{main_branch}:origin_{main_branch}"
+    if not is_shallow(repo):
+        command(["git", "fetch", "origin", refspec], cwd=repo)
+        return repo
+    step = int(os.environ.get("DEPENDS_ON_DEEPEN_STEP", "32"))
+    max_depth = int(os.environ.get("DEPENDS_ON_MAX_DEEPEN", "2048"))
+    head = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=repo, capture_output=True, text=True
+    ).stdout.strip()
+    command(["git", "fetch", f"--depth={step}", "origin", refspec], cwd=repo)
+    depth = step
+    while not git_succeeds(["merge-base", "HEAD", f"origin_{main_branch}"], repo):
+        if depth >= max_depth:
+            log(f"No merge base found in the last {depth} commits")
+            return unshallow(repo, main_branch)
+        step = min(step * 2, max_depth - depth)
+        # deepen both the main branch and the current branch
+        if (
+            command(
+                ["git", "fetch", f"--deepen={step}", "origin", refspec, head],
+                cwd=repo,
+                check=False,
+            )
+            != 0
+        ):
+            return unshallow(repo, main_branch)
+        depth += step
     return repo
 
 
 def merge_main_branch(repo, main_branch):
     "Merge the main branch into the current branch."
     # set a dummy user name and email for the merge process to work
-    command(["git", "config", "--global", "user.name", "Depends-On"], cwd=repo)
-    command(
-        ["git", "config", "--global", "user.email", "depends-on@localhost"], cwd=repo
-    )
+    with _GIT_CONFIG_LOCK:
+        command(["git", "config", "--global", "user.name", "Depends-On"], cwd=repo)
+        command(
+            ["git", "config", "--global", "user.email", "depends-on@localhost"],
+            cwd=repo,
+        )
     command(["git", "config", "commit.gpgsign", "false"], cwd=repo)
-    # update the main branch for shallow clones
-    command(
-        ["git", "fetch", "origin", "--no-depth", f"{main_branch}:origin_{main_branch}"],
-        cwd=repo,
-    )
+    # update the main branch with only the history needed to merge
+    fetch_main_branch(repo, main_branch)
     # merge the main branch into the current branch
     command(["git", "merge", f"origin_{main_branch}", "--no-edit"], cwd=repo)
     return repo
@@ -352,11 +976,29 @@ def check_error(status, message):
         sys.exit(1)
 
 
-def command(cmd, cwd=None):
-    "Execute a command"
+def command(cmd, cwd=None, check=True):
+    "Execute a command and return its exit code. Exit on failure if check is True."
     log(f"+ {shlex.join(cmd)}")
-    ret = subprocess.run(cmd, cwd=cwd)
-    check_error(ret.returncode == 0, f"Command failed with exit code {ret.returncode}")
+    with span(mask(shlex.join(cmd)), os.path.basename(cmd[0])):
+        if getattr(_LOG_BUFFER, "lines", None) is None:
+            ret = subprocess.run(cmd, cwd=cwd)
+        else:
+            # keep the output of the command with the other buffered messages
+            ret = subprocess.run(
+                cmd,
+                cwd=cwd,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                text=True,
+                errors="replace",
+            )
+            if ret.stdout:
+                log(ret.stdout.rstrip("\n"))
+    if check:
+        check_error(
+            ret.returncode == 0, f"Command failed with exit code {ret.returncode}"
+        )
+    return ret.returncode
 
 
 def is_gerrit(change_url):
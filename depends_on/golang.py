@@ -1,80 +1,349 @@
 "golang specific code for stage 3."
 
+import json
 import os
 import re
+import shlex
 import subprocess
+import time
 
-from depends_on.common import log
+from depends_on.common import log, mask, write_if_changed
+from depends_on.trace import span, traced
+
+# tokens of a go.mod or go.work line: comment, quoted string, => or a word
+_TOKEN_RE = re.compile(
+    r'\s*(?://(?P<comment>.*)|(?P<quoted>"(?:\\.|[^"\\])*"|`[^`]*`)'
+    r"|(?P<arrow>=>)|(?P<word>(?:[^\s\"`=]|=(?!>))+))"
+)
+
+# cache of the parsed files: {path: ((mtime, size), model)}
+_MOD_FILE_CACHE = {}
+
+
+def unquote(quoted):
+    "Return the value of a Go quoted string."
+    if quoted[0] == "`":
+        return quoted[1:-1]
+    try:
+        return json.loads(quoted)
+    except ValueError:
+        return quoted[1:-1]
+
+
+def tokenize_line(line):
+    "Return the tokens and the comment of a go.mod or go.work line."
+    tokens = []
+    comment = None
+    pos = 0
+    line = line.rstrip()
+    while pos < len(line):
+        match = _TOKEN_RE.match(line, pos)
+        if not match or match.end() == pos:
+            break
+        pos = match.end()
+        if match.group("comment") is not None:
+            comment = match.group("comment").strip()
+            break
+        if match.group("quoted") is not None:
+            quoted = match.group("quoted")
+            tokens.append(unquote(quoted))
+        else:
+            tokens.append(match.group("arrow") or match.group("word"))
+    return tokens, comment
+
+
+def parse_mod_content(content):
+    """Parse the content of a go.mod or go.work file.
+
+    Returns:
+        dict: module, go and toolchain values, require (path, version,
+        indirect), replace (old_path, old_version, new_path, new_version),
+        exclude (path, version), use (path) and retract (tokens) lists.
+    """
+    model = {
+        "module": None,
+        "go": None,
+        "toolchain": None,
+        "require": [],
+        "replace": [],
+        "exclude": [],
+        "retract": [],
+        "use": [],
+    }
+    block = None
+    for line in content.splitlines():
+        tokens, comment = tokenize_line(line)
+        if not tokens:
+            continue
+        if block:
+            if tokens == [")"]:
+                block = None
+                continue
+            verb, args = block, tokens
+        elif tokens[-1] == "(" and len(tokens) == 2:
+            block = tokens[0]
+            continue
+        else:
+            verb, args = tokens[0], tokens[1:]
+        if verb in ("module", "go", "toolchain") and args:
+            model[verb] = args[0]
+        elif verb == "require" and len(args) >= 2:
+            model["require"].append(
+                {
+                    "path": args[0],
+                    "version": args[1],
+                    "indirect": comment is not None
+                    and (comment == "indirect" or comment.startswith("indirect;")),
+                }
+            )
+        elif verb == "replace" and "=>" in args:
+            arrow = args.index("=>")
+            old, new = args[:arrow], args[arrow + 1 :]
+            if old and new:
+                model["replace"].append(
+                    {
+                        "old_path": old[0],
+                        "old_version": old[1] if len(old) > 1 else None,
+                        "new_path": new[0],
+                        "new_version": new[1] if len(new) > 1 else None,
+                    }
+                )
+        elif verb == "exclude" and len(args) >= 2:
+            model["exclude"].append({"path": args[0], "version": args[1]})
+        elif verb == "use" and args:
+            model["use"].append({"path": args[0]})
+        elif verb == "retract" and args:
+            model["retract"].append(args)
+    return model
+
+
+def parse_mod_file(path):
+    """Return the parsed content of a go.mod or go.work file.
+
+    The result is cached by path, mtime and size so it must not be modified.
+    """
+    path = os.fspath(path)
+    stat = os.stat(path)
+    key = (stat.st_mtime_ns, stat.st_size)
+    cached = _MOD_FILE_CACHE.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    with open(path, "r", encoding="UTF-8") as in_stream:
+        model = parse_mod_content(in_stream.read())
+    _MOD_FILE_CACHE[path] = (key, model)
+    return model
 
 
 def get_modules(go_mod_path):
     """
-    Parses the go.mod file content into a structured dictionary.
+    Return the direct requirements of a go.mod file.
 
     Args:
         go_mod_path (str): The go.mod file to use.
 
     Returns:
-        dict: A structured representation of the required modules.
+        list: The paths of the required modules not marked as indirect.
     """
-    mods = []
+    return [
+        require["path"]
+        for require in parse_mod_file(go_mod_path)["require"]
+        if not require["indirect"]
+    ]
 
-    # Regular expressions to match require directives, excluding lines with "// indirect"
-    single_line_require_re = re.compile(
-        r"^require\s+(\S+)\s+(\S+)(?!.*\/\/\s+indirect)$"
-    )
-    multiline_require_re = re.compile(r"^(\S+)\s+(\S+)(?!.*\/\/\s+indirect)$")
 
-    with open(go_mod_path, "r", encoding="UTF-8") as f:
-        in_multiline_require = False
-        multiline_requires = []
+def get_replacement(model, mod):
+    "Return the (path, version) replacing all the versions of mod or None."
+    for replace in model["replace"]:
+        if replace["old_path"] == mod and replace["old_version"] is None:
+            return replace["new_path"], replace["new_version"]
+    return None
 
-        for line in f.readlines():
-            line = line.strip()  # strip to remove tabs and spaces for multiline require
 
-            # Skip empty lines or comments
-            if not line or line.startswith("//"):
-                continue
+# directories where `go mod tidy` is run by run_deferred_tidy()
+_DEFERRED_TIDY = []
 
-            # Handle require directive (single-line or start of multi-line block)
-            if line.startswith("require ("):
-                in_multiline_require = True
-                multiline_requires = []
-                continue
-            if in_multiline_require:
-                if line == ")":  # End of multiline block
-                    in_multiline_require = False
-                    mods.extend(
-                        multiline_requires
-                    )  # use extend instead of append to merge lists
-                else:
-                    match = multiline_require_re.match(line)
-                    if match:
-                        multiline_requires.append(match.group(1))
-                continue
 
-            # Single-line require directive
-            match = single_line_require_re.match(line)
-            if match:
-                mods.append(match.group(1))
-                continue
+def get_tidy_mode():
+    "Return the DEPENDS_ON_GO_TIDY setting: true, false or defer."
+    mode = os.environ.get("DEPENDS_ON_GO_TIDY", "true").lower()
+    if mode not in ("true", "false", "defer"):
+        raise ValueError(f"Invalid DEPENDS_ON_GO_TIDY value: {mode}")
+    return mode
+
+
+def get_go_mode():
+    "Return the DEPENDS_ON_GO_MODE setting: mod or work."
+    mode = os.environ.get("DEPENDS_ON_GO_MODE", "mod").lower()
+    if mode not in ("mod", "work"):
+        raise ValueError(f"Invalid DEPENDS_ON_GO_MODE value: {mode}")
+    return mode
+
+
+def version_tuple(version):
+    "Return a go version like 1.21.5 as a tuple of ints for comparisons."
+    return tuple(int(part) for part in re.findall(r"\d+", version or "")[:3])
+
 
-    return mods
+def get_workspace_versions(main_dir, model, paths):
+    """Return the highest go and toolchain versions of the main module and paths.
+
+    go.work must list a go version at least as high as the ones of all the
+    used modules. Workspaces need go 1.18 or later.
+    """
+    go_version = model["go"] or "1.18"
+    if version_tuple(go_version) < (1, 18):
+        go_version = "1.18"
+    toolchain = model["toolchain"]
+    for path in paths:
+        go_mod = os.path.join(main_dir, path, "go.mod")
+        if not os.path.exists(go_mod):
+            continue
+        used = parse_mod_file(go_mod)
+        if version_tuple(used["go"]) > version_tuple(go_version):
+            go_version = used["go"]
+        if used["toolchain"] and version_tuple(used["toolchain"]) > version_tuple(
+            toolchain
+        ):
+            toolchain = used["toolchain"]
+    # a toolchain older than the go version is ignored by go
+    if toolchain and version_tuple(toolchain) <= version_tuple(go_version):
+        toolchain = None
+    return go_version, toolchain
+
+
+def write_go_work(main_dir, model, paths):
+    """Add the use directives of paths to the go.work file of main_dir.
+
+    go.work is created with the main module if it doesn't exist. Its go and
+    toolchain lines are raised to the highest versions of the used modules.
+    Returns True if the file was changed.
+    """
+    go_work = os.path.join(main_dir, "go.work")
+    go_version, toolchain = get_workspace_versions(main_dir, model, paths)
+    if os.path.exists(go_work):
+        work_model = parse_mod_file(go_work)
+        used = {use["path"] for use in work_model["use"]}
+        with open(go_work, "r", encoding="UTF-8") as in_stream:
+            content = in_stream.read()
+        if version_tuple(go_version) > version_tuple(work_model["go"]):
+            content = re.sub(
+                r"^go\s+\S+", f"go {go_version}", content, count=1, flags=re.M
+            )
+        if toolchain and version_tuple(toolchain) > version_tuple(
+            work_model["toolchain"]
+        ):
+            if work_model["toolchain"]:
+                content = re.sub(
+                    r"^toolchain\s+\S+",
+                    f"toolchain {toolchain}",
+                    content,
+                    count=1,
+                    flags=re.M,
+                )
+            else:
+                content = re.sub(
+                    r"^(go\s+\S+.*)$",
+                    rf"\1\ntoolchain {toolchain}",
+                    content,
+                    count=1,
+                    flags=re.M,
+                )
+    else:
+        used = set()
+        content = f"go {go_version}\n"
+        if toolchain:
+            content += f"toolchain {toolchain}\n"
+        paths = ["."] + paths
+    new_paths = [path for path in paths if path not in used]
+    if new_paths:
+        content += "\nuse (\n" + "".join(f"\t{path}\n" for path in new_paths) + ")\n"
+    return write_if_changed(go_work, content)
+
+
+def get_major_version(mod):
+    "Return the major version implied by the path of a module: /vN or gopkg.in .vN suffix."
+    match = re.search(r"/v(\d+)$", mod)
+    if match:
+        return int(match.group(1))
+    match = re.match(r"gopkg\.in/.*\.v(\d+)$", mod)
+    if match:
+        return int(match.group(1))
+    return 0
+
+
+def resolve_pseudo_version(mod, info):
+    """Return the pseudo-version of the head of the fork branch of a dependency.
+
+    The commit is looked up with git ls-remote and its time is read from the
+    local checkout in info["path"]. Returns None if it cannot be computed.
+    """
+    fork_url = info["fork_url"]
+    branch = info["branch"]
+    # the Gitlab URLs can contain the token
+    with span(mask(f"git ls-remote {fork_url} {branch}"), "git"):
+        ret = subprocess.run(
+            ["git", "ls-remote", fork_url, f"refs/heads/{branch}"],
+            capture_output=True,
+            text=True,
+        )
+    if ret.returncode != 0 or not ret.stdout.strip():
+        log(f"Unable to find the branch {branch} in {fork_url}")
+        return None
+    sha = ret.stdout.split()[0]
+    with span(f"git show -s --format=%ct {sha}", "git"):
+        ret = subprocess.run(
+            ["git", "show", "-s", "--format=%ct", sha],
+            cwd=info["path"],
+            capture_output=True,
+            text=True,
+        )
+    if ret.returncode != 0:
+        log(f"Commit {sha} of {fork_url} not found in {info['path']}")
+        return None
+    timestamp = time.strftime("%Y%m%d%H%M%S", time.gmtime(int(ret.stdout.strip())))
+    return f"v{get_major_version(mod)}.0.0-{timestamp}-{sha[:12]}"
+
+
+def run_go(args, cwd=None, env=None):
+    "Run a go command and raise an exception on failure."
+    with span(shlex.join(["go"] + args), "go"):
+        subprocess.run(["go"] + args, check=True, cwd=cwd, env=env)
 
 
+def run_deferred_tidy():
+    "Run `go mod tidy` in the directories deferred by process_golang."
+    env = dict(os.environ, GOFLAGS="-mod=mod")
+    while _DEFERRED_TIDY:
+        go_dir = _DEFERRED_TIDY.pop(0)
+        log(f"Running deferred go mod tidy in {go_dir}")
+        run_go(["mod", "tidy"], cwd=go_dir, env=env)
+
+
+@traced("processor")
 def process_golang(main_dir, dirs, container_mode):
     "Add replace directives in go.mod for the local dependencies."
     go_mod = os.path.join(main_dir, "go.mod")
     if not os.path.exists(go_mod):
         return False
     log(f"processing {go_mod}")
+    tidy_mode = get_tidy_mode()
+    go_mode = "mod" if container_mode else get_go_mode()
+    pin = os.environ.get("DEPENDS_ON_GO_PIN", "false").lower() == "true"
     # get the list of github.com/... dependencies that are in the local dependencies
+    model = parse_mod_file(go_mod)
     go_modules = get_modules(go_mod)
     if len(go_modules) == 0:
         raise ValueError("No Go modules found in the project")
 
-    # add the replace directives to go.mod for the local dependencies
-    nb_replace = 0
+    if go_mode == "work":
+        # use the local dependencies in a workspace, leaving go.mod and go.sum untouched
+        paths = [dirs[mod]["path"] for mod in go_modules if mod in dirs]
+        for path in paths:
+            log(f"Adding {path} to go.work")
+        return write_go_work(main_dir, model, paths)
+
+    # collect the replace directives to add them to go.mod in one go mod edit call
+    replace_args = []
     for mod in go_modules:
         if mod in dirs:
             if container_mode:
@@ -84,32 +353,33 @@ def process_golang(main_dir, dirs, container_mode):
                     .replace("https://", "", 1)
                     .replace(".git", "", 1)
                 )
-                log(
-                    f"Adding replace directive in go.mod for {mod} => {fork_url} {dirs[mod]['branch']}"
-                )
-                subprocess.run(
-                    [
-                        "go",
-                        "mod",
-                        "edit",
-                        "-replace",
-                        f"{mod}={fork_url}@{dirs[mod]['branch']}",
-                    ],
-                    check=True,
-                )
+                version = dirs[mod]["branch"]
+                if pin:
+                    # pin the branch to its commit to hit the module cache in later builds
+                    version = resolve_pseudo_version(mod, dirs[mod]) or version
+                target = (fork_url, version)
             else:
-                log(
-                    f"Adding replace directive in go.mod for {mod} => {dirs[mod]['path']}"
-                )
-                subprocess.run(
-                    ["go", "mod", "edit", "-replace", f"{mod}={dirs[mod]['path']}"],
-                    check=True,
-                )
-            nb_replace += 1
-    # if there is any change to go.mod, `go mod tidy` needs to be called to have a correct go.sums
-    if nb_replace > 0:
-        subprocess.run(["go", "mod", "tidy"], check=True)
-    return nb_replace > 0
+                target = (dirs[mod]["path"], None)
+            if get_replacement(model, mod) == target:
+                log(f"{mod} is already replaced by {target[0]} in go.mod")
+                continue
+            log(f"Adding replace directive in go.mod for {mod} => {target[0]}")
+            replace_args += [
+                "-replace",
+                f"{mod}={target[0]}@{target[1]}" if target[1] else f"{mod}={target[0]}",
+            ]
+    if len(replace_args) == 0:
+        return False
+    run_go(["mod", "edit"] + replace_args, cwd=main_dir)
+    # as go.mod changed, `go mod tidy` needs to be called to have a correct go.sum
+    if tidy_mode == "true":
+        run_go(["mod", "tidy"], cwd=main_dir)
+    elif tidy_mode == "defer":
+        if main_dir not in _DEFERRED_TIDY:
+            _DEFERRED_TIDY.append(main_dir)
+    else:
+        log(f"Skipping go mod tidy in {main_dir}")
+    return True
 
 
 # golang.py ends here
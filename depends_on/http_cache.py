@@ -0,0 +1,81 @@
+"On-disk cache of HTTP responses used for the forge API calls."
+
+import hashlib
+import json
+import os
+import tempfile
+import time
+
+
+def cache_key(url, headers):
+    "Return the cache key of a request: the URL and the headers (auth identity included)."
+    # the headers are hashed so the tokens are never written to disk
+    identity = json.dumps([url, sorted(headers.items())])
+    return hashlib.sha256(identity.encode("utf-8")).hexdigest()
+
+
+def load(cache_dir, key):
+    "Return the cached entry for key or None. Mark the entry as recently used."
+    fname = os.path.join(cache_dir, f"{key}.json")
+    try:
+        with open(fname, "r", encoding="UTF-8") as in_stream:
+            entry = json.load(in_stream)
+        os.utime(fname)
+    except (OSError, ValueError):
+        return None
+    return entry
+
+
+def store(cache_dir, key, url, body, etag=None, last_modified=None):
+    "Store a response in the cache and return the new entry."
+    entry = {
+        "url": url,
+        "etag": etag,
+        "last_modified": last_modified,
+        "fetched": time.time(),
+        "body": body,
+    }
+    os.makedirs(cache_dir, exist_ok=True)
+    # write to a temporary file first as other jobs can read the cache concurrently
+    fd, tmp_fname = tempfile.mkstemp(prefix=".tmp-", suffix=".json", dir=cache_dir)
+    with os.fdopen(fd, "w", encoding="UTF-8") as out_stream:
+        json.dump(entry, out_stream)
+    os.replace(tmp_fname, os.path.join(cache_dir, f"{key}.json"))
+    return entry
+
+
+def is_fresh(entry, ttl):
+    "Return True if the entry has been fetched less than ttl seconds ago."
+    return time.time() - entry["fetched"] < ttl
+
+
+def evict(cache_dir, max_size):
+    "Remove the least recently used entries until the cache is below max_size bytes."
+    entries = []
+    total_size = 0
+    with os.scandir(cache_dir) as it:
+        for dir_entry in it:
+            if not dir_entry.name.endswith(".json") or dir_entry.name.startswith("."):
+                continue
+            try:
+                stat = dir_entry.stat()
+            except OSError:
+                # removed by another job since the directory was listed
+                continue
+            entries.append((stat.st_mtime, stat.st_size, dir_entry.path))
+            total_size += stat.st_size
+    entries.sort()
+    nb_removed = 0
+    for _, size, path in entries:
+        if total_size <= max_size:
+            break
+        try:
+            os.unlink(path)
+        except OSError:
+            continue
+        total_size -= size
+        nb_removed += 1
+    return nb_removed
+
+
+# http_cache.py ends here
@@ -0,0 +1,126 @@
+"""Pool of persistent HTTP connections used for the forge API calls.
+
+The connections are kept alive and shared per (scheme, host, port) so many
+API calls to the same server only pay one TCP and TLS handshake.
+"""
+
+import http.client
+import io
+import threading
+import urllib.parse
+import urllib.request
+from urllib.error import HTTPError, URLError
+
+_TIMEOUT = 60
+_MAX_REDIRECTS = 5
+_REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+# idle connections by (scheme, host, port)
+_IDLE_CONNECTIONS = {}
+_LOCK = threading.Lock()
+
+
+class Response(io.BytesIO):
+    "Fully read HTTP response, compatible with what urllib.request.urlopen returns."
+
+    def __init__(self, url, status, headers, content):
+        super().__init__(content)
+        self.url = url
+        self.status = status
+        self.headers = headers
+
+    def getcode(self):
+        "Return the HTTP status code."
+        return self.status
+
+
+def _get_connection(key):
+    "Return an idle connection for key or a new one, with a flag telling if it is reused."
+    with _LOCK:
+        idle_connections = _IDLE_CONNECTIONS.get(key)
+        if idle_connections:
+            return idle_connections.pop(), True
+    scheme, host, port = key
+    if scheme == "https":
+        return http.client.HTTPSConnection(host, port, timeout=_TIMEOUT), False
+    return http.client.HTTPConnection(host, port, timeout=_TIMEOUT), False
+
+
+def _release_connection(key, connection):
+    "Put back a connection in the pool."
+    with _LOCK:
+        _IDLE_CONNECTIONS.setdefault(key, []).append(connection)
+
+
+def close_all():
+    "Close all the idle connections."
+    with _LOCK:
+        for idle_connections in _IDLE_CONNECTIONS.values():
+            for connection in idle_connections:
+                connection.close()
+        _IDLE_CONNECTIONS.clear()
+
+
+def _use_proxy(url_parts):
+    "Return True if a proxy is configured for this URL."
+    return url_parts.scheme in urllib.request.getproxies() and not (
+        urllib.request.proxy_bypass(url_parts.hostname)
+    )
+
+
+def _send(key, method, path, data, headers):
+    "Send a request on a pooled connection and return the response and its content."
+    for attempt in range(2):
+        connection, reused = _get_connection(key)
+        try:
+            connection.request(method, path, body=data, headers=headers)
+            response = connection.getresponse()
+            content = response.read()
+        except (http.client.HTTPException, OSError) as exc:
+            connection.close()
+            # the server may have closed an idle connection, retry once on a new one
+            if reused and attempt == 0 and method in ("GET", "HEAD"):
+                continue
+            raise URLError(exc) from exc
+        if response.will_close:
+            connection.close()
+        else:
+            _release_connection(key, connection)
+        return response, content
+
+
+def urlopen(req, redirects=_MAX_REDIRECTS):
+    """Open a urllib.request.Request on a pooled connection.
+
+    Like urllib.request.urlopen, redirections are followed and HTTPError is
+    raised for non 2xx responses. Fall back to urllib.request.urlopen when a
+    proxy is configured.
+    """
+    url_parts = urllib.parse.urlsplit(req.full_url)
+    if url_parts.scheme not in ("http", "https") or _use_proxy(url_parts):
+        return urllib.request.urlopen(req, timeout=_TIMEOUT)
+    key = (url_parts.scheme, url_parts.hostname, url_parts.port)
+    path = url_parts.path or "/"
+    if url_parts.query:
+        path += "?" + url_parts.query
+    headers = {"User-Agent": f"Python-urllib/{urllib.request.__version__}"}
+    headers.update(req.header_items())
+    response, content = _send(key, req.get_method(), path, req.data, headers)
+    if response.status in _REDIRECT_CODES and redirects > 0:
+        location = urllib.parse.urljoin(
+            req.full_url, response.headers.get("Location", "")
+        )
+        redirected_req = urllib.request.Request(location, headers=dict(req.headers))
+        return urlopen(redirected_req, redirects - 1)
+    if not 200 <= response.status < 300:
+        raise HTTPError(
+            req.full_url,
+            response.status,
+            response.reason,
+            response.headers,
+            io.BytesIO(content),
+        )
+    return Response(req.full_url, response.status, response.headers, content)
+
+
+# http_pool.py ends here
@@ -3,8 +3,10 @@
 import glob
 import json
 import os
+import re
 
-from depends_on.common import log
+from depends_on.common import log, write_if_changed
+from depends_on.trace import traced
 
 
 def load_package_json(package_json_path):
@@ -13,6 +15,92 @@ def load_package_json(package_json_path):
         return json.load(package_json)
 
 
+# sections of package.json where the local dependencies are replaced
+DEPENDENCY_SECTIONS = (
+    "dependencies",
+    "devDependencies",
+    "peerDependencies",
+    "optionalDependencies",
+)
+
+
+def get_workspace_globs(package, project_dir=None):
+    """Return the workspace patterns of a package.json: array or object form.
+
+    The patterns of the pnpm-workspace.yaml file of project_dir are added
+    if it exists.
+    """
+    workspaces = package.get("workspaces", [])
+    if isinstance(workspaces, dict):
+        workspaces = workspaces.get("packages", [])
+    workspaces = list(workspaces)
+    if project_dir:
+        pnpm_workspace = os.path.join(project_dir, "pnpm-workspace.yaml")
+        if os.path.exists(pnpm_workspace):
+            # imported here as PyYAML is only needed for pnpm projects
+            import yaml
+
+            with open(pnpm_workspace, "r", encoding="UTF-8") as in_stream:
+                workspaces += (yaml.safe_load(in_stream) or {}).get("packages") or []
+    return workspaces
+
+
+def get_workspace_dirs(project_dir, globs):
+    "Return the sorted directories matching the workspace patterns that contain a package.json."
+    workspace_dirs = set()
+    excluded_dirs = set()
+    for workspace_glob in globs:
+        # !pattern excludes the directories matching pattern
+        excluded = workspace_glob.startswith("!")
+        for workspace_dir in glob.glob(
+            os.path.join(project_dir, workspace_glob.lstrip("!")), recursive=True
+        ):
+            if excluded:
+                excluded_dirs.add(os.path.normpath(workspace_dir))
+            elif os.path.exists(os.path.join(workspace_dir, "package.json")):
+                workspace_dirs.add(os.path.normpath(workspace_dir))
+    return sorted(workspace_dirs - excluded_dirs)
+
+
+# cache of the packages of the local dependencies:
+# {project dir: (stat of package.json and pnpm-workspace.yaml, packages)}
+_PACKAGE_INDEX_CACHE = {}
+
+
+def get_package_index(project_dir):
+    """Return the packages of a project as {name: directory}: the root package and its workspaces.
+
+    The result is computed once and reused until package.json or
+    pnpm-workspace.yaml changes.
+    """
+    key = []
+    for fname in ("package.json", "pnpm-workspace.yaml"):
+        try:
+            stat = os.stat(os.path.join(project_dir, fname))
+            key.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            key.append(None)
+    cached = _PACKAGE_INDEX_CACHE.get(project_dir)
+    if cached and cached[0] == key:
+        return cached[1]
+    packages = {}
+    if key[0]:
+        package = load_package_json(os.path.join(project_dir, "package.json"))
+        if "name" in package:
+            packages[package["name"]] = project_dir
+        for workspace_dir in get_workspace_dirs(
+            project_dir, get_workspace_globs(package, project_dir)
+        ):
+            workspace_package = load_package_json(
+                os.path.join(workspace_dir, "package.json")
+            )
+            if "name" in workspace_package:
+                log(f"found package {workspace_package['name']} in {workspace_dir}")
+                packages[workspace_package["name"]] = workspace_dir
+    _PACKAGE_INDEX_CACHE[project_dir] = (key, packages)
+    return packages
+
+
 def local_dependencies(dirs):
     """Return a dictionary of local dependencies with the name as key
     and the directory as value. It also looks for workspaces in package.json."""
@@ -24,41 +112,33 @@ def local_dependencies(dirs):
             )
         else:
             local_path = dirs[local_dir]["path"]
-        package_json_path = os.path.join(local_path, "package.json")
-        if os.path.exists(package_json_path):
-            package = load_package_json(package_json_path)
-            deps[package["name"]] = dirs[local_dir]
-            if "workspaces" in package and "packages" in package["workspaces"]:
-                log("detected workspaces")
-                for workspace_glob in package["workspaces"]["packages"]:
-                    log(f"processing {workspace_glob}")
-                    for workspace_dir in glob.glob(
-                        os.path.join(local_path, workspace_glob)
-                    ):
-                        log(f"found subdir={workspace_dir}")
-                        workspace_path = os.path.join(local_path, workspace_dir)
-                        log(f"checking workspace {workspace_path} for package.json")
-                        workspace_package_json_path = os.path.join(
-                            workspace_path, "package.json"
-                        )
-                        if os.path.exists(workspace_package_json_path):
-                            workspace_package = load_package_json(
-                                workspace_package_json_path
-                            )
-                            log(f"found package {workspace_package['name']}")
-                            deps[workspace_package["name"]] = {
-                                "path": workspace_path,
-                                "subdir": workspace_dir[len(local_path) + 1 :],
-                                "fork_url": dirs[local_dir]["fork_url"],
-                                "branch": dirs[local_dir]["branch"],
-                            }
+        for name, package_dir in get_package_index(local_path).items():
+            if package_dir == local_path:
+                deps[name] = dirs[local_dir]
+            else:
+                deps[name] = dict(
+                    dirs[local_dir],
+                    path=package_dir,
+                    subdir=os.path.relpath(package_dir, local_path),
+                )
     return deps
 
 
-def process_dependencies(dependencies, dirs, container_mode):
+def dump_json(path, data, original):
+    "Write data to a JSON file with the indentation and final newline of its original content."
+    match = re.search(r"^[{\[]\s*\n([ \t]+)", original)
+    indent = match.group(1) if match else 2
+    content = json.dumps(data, indent=indent, ensure_ascii=False)
+    if original.endswith("\n"):
+        content += "\n"
+    return write_if_changed(path, content)
+
+
+def process_dependencies(dependencies, dirs, container_mode, local_deps=None):
     """Process dependencies in package.json and replace local dependencies"""
-    local_deps = local_dependencies(dirs)
-    log(f"Found {len(local_deps)} local dependencies: {local_deps=}")
+    if local_deps is None:
+        local_deps = local_dependencies(dirs)
+        log(f"Found {len(local_deps)} local dependencies: {local_deps=}")
     count = 0
     for dependency in dependencies:
         if dependency in local_deps:
@@ -78,23 +158,251 @@ def process_dependencies(dependencies, dirs, container_mode):
     return count
 
 
+def process_package_json(package_json_path, local_deps, container_mode):
+    """Replace the local dependencies in all the sections of a package.json file.
+
+    Returns {section: {name: new spec}} for the replaced dependencies.
+    """
+    with open(package_json_path, "r", encoding="UTF-8") as in_stream:
+        original = in_stream.read()
+    package = json.loads(original)
+    replaced = {}
+    for section in DEPENDENCY_SECTIONS:
+        dependencies = package.get(section)
+        if not isinstance(dependencies, dict):
+            continue
+        old = dict(dependencies)
+        process_dependencies(dependencies, None, container_mode, local_deps)
+        changed = {
+            name: spec for name, spec in dependencies.items() if old[name] != spec
+        }
+        if changed:
+            replaced[section] = changed
+    if replaced:
+        dump_json(package_json_path, package, original)
+    return replaced
+
+
+def is_lock_entry_of(key, names):
+    "Return True if the package-lock.json key is an installation of one of names."
+    parts = key.split("node_modules/")
+    return len(parts) > 1 and any(part.rstrip("/") in names for part in parts[1:])
+
+
+def patch_package_lock(main_dir, replaced, local_deps, container_mode):
+    """Update the entries of the replaced dependencies in package-lock.json.
+
+    replaced is {workspace dir relative to main_dir: {section: {name: spec}}}.
+    The other entries are kept so npm only resolves what changed. Local
+    dependencies are recorded as links like npm does for file: specs; in
+    container mode their entries are removed for npm to resolve them again.
+    """
+    lock_path = os.path.join(main_dir, "package-lock.json")
+    if not os.path.exists(lock_path):
+        return False
+    with open(lock_path, "r", encoding="UTF-8") as in_stream:
+        original = in_stream.read()
+    lock = json.loads(original)
+    names = {
+        name
+        for sections in replaced.values()
+        for deps in sections.values()
+        for name in deps
+    }
+    packages = lock.get("packages", {})
+    # the specifications of the root and workspace packages
+    for rel_dir, sections in replaced.items():
+        entry = packages.get(rel_dir)
+        if entry is None:
+            continue
+        for section, deps in sections.items():
+            entry.setdefault(section, {}).update(deps)
+    for key in [key for key in packages if is_lock_entry_of(key, names)]:
+        entry = packages.pop(key)
+        # the target of a link is recorded in its own entry
+        if entry.get("link"):
+            packages.pop(entry.get("resolved"), None)
+    legacy = lock.get("dependencies", {})
+    for name in names:
+        legacy.pop(name, None)
+    if not container_mode:
+        for name in sorted(names):
+            local_path = local_deps[name]["path"]
+            rel_path = os.path.relpath(local_path, main_dir)
+            package_json_path = os.path.join(local_path, "package.json")
+            package = (
+                load_package_json(package_json_path)
+                if os.path.exists(package_json_path)
+                else {}
+            )
+            packages[f"node_modules/{name}"] = {"resolved": rel_path, "link": True}
+            target = {"name": name, "version": package.get("version", "0.0.0")}
+            for section in DEPENDENCY_SECTIONS:
+                if package.get(section):
+                    target[section] = package[section]
+            packages[rel_path] = target
+            if "dependencies" in lock:
+                legacy[name] = {"version": f"file:{rel_path}"}
+    log(f"Patching {lock_path} for {sorted(names)}")
+    return dump_json(lock_path, lock, original)
+
+
+def yarn_lock_names(header):
+    "Return the package names of a yarn.lock entry header."
+    names = set()
+    for spec in header.rstrip().rstrip(":").split(","):
+        spec = spec.strip().strip('"')
+        at = spec.find("@", 1)
+        names.add(spec[:at] if at > 0 else spec)
+    return names
+
+
+def patch_yarn_lock(main_dir, names):
+    """Remove the entries of the replaced dependencies from yarn.lock.
+
+    yarn then resolves only these entries again, keeping the other ones.
+    """
+    lock_path = os.path.join(main_dir, "yarn.lock")
+    if not os.path.exists(lock_path):
+        return False
+    lines = []
+    skip = False
+    with open(lock_path, "r", encoding="UTF-8") as in_stream:
+        for line in in_stream:
+            if line[:1] not in (" ", "\t", "#", "\n", "\r", ""):
+                # header of an entry, the entry ends at the next blank line
+                skip = bool(yarn_lock_names(line) & names)
+                if skip:
+                    log(f"Removing {line.strip()} from {lock_path}")
+            elif not line.strip():
+                skip = False
+            if not skip:
+                lines.append(line)
+    # collapse the blank lines left by the removed entries
+    content = re.sub(r"\n{3,}", "\n\n", "".join(lines))
+    return write_if_changed(lock_path, content)
+
+
+# key of a pnpm-lock.yaml mapping line: indentation, plain or quoted key
+_PNPM_KEY_RE = re.compile(
+    r"""^( *)('(?:[^']|'')*'|"(?:[^"\\]|\\.)*"|[^\s'"#-].*?)\s*:(?:\s|$)"""
+)
+
+
+def pnpm_key(key):
+    "Return the value of a plain or quoted pnpm-lock.yaml key."
+    if key.startswith("'"):
+        return key[1:-1].replace("''", "'")
+    if key.startswith('"'):
+        return json.loads(key)
+    return key
+
+
+def pnpm_package_name(key):
+    "Return the package name of a packages or snapshots key of pnpm-lock.yaml."
+    # keys like /name@1.0.0, name@1.0.0 or /name/1.0.0 (lockfile v5)
+    bare_key = key.lstrip("/")
+    at = bare_key.find("@", 1)
+    return bare_key[:at] if at > 0 else bare_key.rsplit("/", 1)[0]
+
+
+def is_pnpm_entry_of(path, names):
+    "Return True if the key path of a pnpm-lock.yaml line is an entry of one of names."
+    sections = DEPENDENCY_SECTIONS + ("specifiers",)
+    if len(path) == 2 and path[0] in ("packages", "snapshots"):
+        return pnpm_package_name(path[1]) in names
+    # dependencies of the root importer at the top level (lockfile v5 and v6)
+    if len(path) == 2 and path[0] in sections:
+        return path[1] in names
+    if len(path) == 4 and path[0] == "importers" and path[2] in sections:
+        return path[3] in names
+    return False
+
+
+def patch_pnpm_lock(main_dir, names):
+    """Remove the entries of the replaced dependencies from pnpm-lock.yaml.
+
+    The importers keep their other dependencies pinned and pnpm resolves
+    the removed ones again. The entries are removed line by line, keeping
+    the rest of the file as written by pnpm.
+    """
+    lock_path = os.path.join(main_dir, "pnpm-lock.yaml")
+    if not os.path.exists(lock_path):
+        return False
+    lines = []
+    # (indentation, key, index in lines) of the enclosing mappings
+    stack = []
+    # index in lines of the mappings where entries were removed
+    parents = set()
+    skip_indent = None
+    with open(lock_path, "r", encoding="UTF-8") as in_stream:
+        for line in in_stream:
+            match = _PNPM_KEY_RE.match(line)
+            if not line.strip() or line.lstrip().startswith("#") or not match:
+                if skip_indent is None or not line.strip():
+                    lines.append(line)
+                continue
+            indent = len(match.group(1))
+            if skip_indent is not None:
+                if indent > skip_indent:
+                    continue
+                skip_indent = None
+            while stack and stack[-1][0] >= indent:
+                stack.pop()
+            path = [key for _, key, _ in stack] + [pnpm_key(match.group(2))]
+            if is_pnpm_entry_of(path, names):
+                log(f"Removing {'/'.join(path)} from {lock_path}")
+                skip_indent = indent
+                if stack:
+                    parents.add(stack[-1][2])
+                continue
+            stack.append((indent, path[-1], len(lines)))
+            lines.append(line)
+    # a mapping without entries left is written as an empty flow mapping
+    for parent in parents:
+        following = [line for line in lines[parent + 1 :] if line.strip()]
+        indent = len(lines[parent]) - len(lines[parent].lstrip(" "))
+        if not following or len(following[0]) - len(following[0].lstrip(" ")) <= indent:
+            lines[parent] = lines[parent].rstrip("\r\n").rstrip() + " {}\n"
+    # collapse the blank lines left by the removed entries
+    content = re.sub(r"\n{3,}", "\n\n", "".join(lines)).rstrip("\n") + "\n"
+    return write_if_changed(lock_path, content)
+
+
+@traced("processor")
 def process_javascript(main_dir, dirs, container_mode):
     """Use changes from PR in package.json if present"""
     package_json_path = os.path.join(main_dir, "package.json")
     if not os.path.exists(package_json_path):
         return False
     log("Detected package.json file, checking for local dependencies")
+    local_deps = local_dependencies(dirs)
+    log(f"Found {len(local_deps)} local dependencies: {local_deps=}")
+    # the root package and the workspace packages of the main project
     package = load_package_json(package_json_path)
-    if "dependencies" not in package:
+    replaced = {}
+    for package_dir in [main_dir] + get_workspace_dirs(
+        main_dir, get_workspace_globs(package, main_dir)
+    ):
+        rel_dir = os.path.relpath(package_dir, main_dir)
+        sections = process_package_json(
+            os.path.join(package_dir, "package.json"), local_deps, container_mode
+        )
+        if sections:
+            replaced["" if rel_dir == "." else rel_dir] = sections
+    if not replaced:
         return False
-    dependencies = package["dependencies"]
-    count = process_dependencies(dependencies, dirs, container_mode)
-    if "devDependencies" in package:
-        dependencies = package["devDependencies"]
-        count += process_dependencies(dependencies, dirs, container_mode)
-    with open(package_json_path, "w", encoding="UTF-8") as package_json:
-        json.dump(package, package_json, indent=2)
-    return count > 0
+    names = {
+        name
+        for sections in replaced.values()
+        for deps in sections.values()
+        for name in deps
+    }
+    # only the entries of the replaced dependencies are changed in the lock files
+    patch_package_lock(main_dir, replaced, local_deps, container_mode)
+    patch_yarn_lock(main_dir, names)
+    patch_pnpm_lock(main_dir, names)
+    return True
 
 
 # javascript.py ends here
@@ -1,20 +1,55 @@
 "Python specific code for stage 3."
 
+import configparser
 import os
+import pathlib
 import re
+import shutil
 
-from depends_on.common import log
+from depends_on.common import command, log, write_if_changed
+from depends_on.trace import traced
+
+
+def normalize_name(name):
+    "Normalize a distribution name as described in PEP 503."
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+# TOML strings on a single line: basic and literal
+_TOML_STRING_RE = re.compile(r'"(?:\\.|[^"\\])*"|\'[^\']*\'')
+# key = value line of a TOML table
+_TOML_KEY_RE = re.compile(r"""^(\s*)("[^"]*"|'[^']*'|[A-Za-z0-9_-]+)(\s*=\s*)(.*)$""")
+# [table] or [[array.of.tables]] header
+_TOML_TABLE_RE = re.compile(r"^\s*\[\[?([^\]]+)\]\]?\s*(?:#.*)?$")
+# name and extras of a PEP 508 requirement
+_REQUIREMENT_RE = re.compile(
+    r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*(.*)$"
+)
+# tables where each key is a dependency and each value its specification
+_POETRY_TABLE_RE = re.compile(
+    r"^tool\.poetry\.(dependencies|dev-dependencies|group\.[^.]+\.dependencies)$"
+)
+
+
+# cache of the names of the local dependencies: {path: (stat of the files, name)}
+_NAME_CACHE = {}
 
 
 def lookup_pyproject_name(fname) -> str:
     "Lookup the name of a module in a pyproject.toml file."
+    table = None
     with open(fname, "r", encoding="UTF-8") as in_stream:
         for line in in_stream.readlines():
-            match = re.match(r"^\s*name\s*=\s*['\"](.*?)['\"]\s*$", line)
+            match = _TOML_TABLE_RE.match(line)
+            if match:
+                table = toml_table_name(match.group(1))
+                continue
+            if table not in (None, "project", "tool.poetry"):
+                continue
+            match = re.match(r"^\s*name\s*=\s*['\"](.*?)['\"]\s*(?:#.*)?$", line)
             if match:
                 return match.group(1)
-        if not match:
-            raise KeyError("name not found in pyproject.toml")
+    raise KeyError("name not found in pyproject.toml")
 
 
 def lookup_setuppy_name(fname) -> str:
@@ -29,107 +64,520 @@ def lookup_setuppy_name(fname) -> str:
     return None
 
 
+def lookup_setupcfg_name(fname) -> str:
+    "Lookup the name of a module in the [metadata] section of a setup.cfg file."
+    if os.path.exists(fname):
+        parser = configparser.ConfigParser(interpolation=None)
+        try:
+            parser.read(fname, encoding="UTF-8")
+        except configparser.Error as exc:
+            log(f"Unable to parse {fname}: {exc}")
+            return None
+        return parser.get("metadata", "name", fallback=None) or None
+    return None
+
+
+def lookup_module_name(path):
+    """Return the distribution name of the Python project in path or None.
+
+    The name is looked up in setup.py, setup.cfg then pyproject.toml and
+    cached until one of these files changes.
+    """
+    fnames = [
+        os.path.join(path, fname)
+        for fname in ("setup.py", "setup.cfg", "pyproject.toml")
+    ]
+    key = []
+    for fname in fnames:
+        try:
+            stat = os.stat(fname)
+            key.append((stat.st_mtime_ns, stat.st_size))
+        except OSError:
+            key.append(None)
+    cached = _NAME_CACHE.get(path)
+    if cached and cached[0] == key:
+        return cached[1]
+    name = lookup_setuppy_name(fnames[0]) or lookup_setupcfg_name(fnames[1])
+    if not name and key[2]:
+        try:
+            name = lookup_pyproject_name(fnames[2])
+        except KeyError:
+            log(f"No name found in {fnames[2]}")
+    _NAME_CACHE[path] = (key, name)
+    return name
+
+
 def get_modules(dirs):
-    "Get the dictionary of python modules from the local dependencies."
+    "Get the dictionary of python modules from the local dependencies by normalized name."
     python_mods = {}
     for _dir in dirs:
-        name = lookup_setuppy_name(
-            os.path.join(dirs[_dir]["path"], "setup.py")
-        ) or lookup_pyproject_name(os.path.join(dirs[_dir]["path"], "pyproject.toml"))
+        name = lookup_module_name(dirs[_dir]["path"])
         if name:
-            python_mods[name] = dirs[_dir]
+            python_mods[normalize_name(name)] = dirs[_dir]
     return python_mods
 
 
-def process_python_requirements(main_dir, dirs, container_mode):
-    "Replace modules in requirements.txt for the local dependencies."
+# -r/--requirement and -c/--constraint options of a requirements file
+_INCLUDE_RE = re.compile(
+    r"^\s*(-r|--requirement|-c|--constraint)(?:\s*=\s*|\s+|(?<=-[rc]))(\S+)"
+)
+
+
+def split_requirement_comment(line):
+    "Return a requirement line without its comment: # at the start or after a space."
+    match = re.search(r"(^|\s)#", line)
+    return line[: match.start()] if match else line
+
+
+# VCS requirement named by its #egg= fragment, editable or not
+_VCS_EGG_RE = re.compile(
+    r"^\s*(?:(?:-e|--editable)(?:\s*=\s*|\s+))?(?:git|hg|svn|bzr)\+\S*"
+    r"#(?:\S*&)?egg=([A-Za-z0-9][A-Za-z0-9._-]*)(\[[^\]]*\])?"
+)
+
+
+def requirement_line(name, extras, marker, info, container_mode):
+    "Return the requirements.txt line installing a local dependency."
+    if container_mode:
+        # doc at https://pip.pypa.io/en/stable/cli/pip_install/#git
+        pkg = f"{name}{extras} @ git+{info['fork_url']}@{info['branch']}"
+        if "subdir" in info:
+            pkg += f"#egg=subdir&subdirectory={info['subdir']}"
+    elif marker:
+        # markers cannot be used with -e
+        pkg = f"{name}{extras} @ {pathlib.Path(info['path']).as_uri()}"
+    else:
+        return f"-e {info['path']}{extras}"
+    if marker:
+        pkg += f" ; {marker}"
+    return pkg
+
+
+# --hash and --require-hashes options putting pip in hash-checking mode
+_HASH_OPTION_RE = re.compile(r"(?:^|\s+)--(?:hash(?:\s*=\s*|\s+)\S+|require-hashes\b)")
+
+
+def rewrite_requirements(
+    fname, root_dir, module_dirs, container_mode, files, constraints=False
+):
+    """Replace the local dependencies in a requirements file and the files it includes.
+
+    The files are read line by line and the -r and -c includes inside
+    root_dir are followed, each file being rewritten at most once thanks to
+    the files dict indexed by real path. It receives for each file its name
+    and its logical lines as (text, logical line, code) tuples, code being
+    None for the replaced requirements. In constraints files, the constraints
+    on the local dependencies are removed as pip doesn't accept paths or URLs
+    there.
+
+    Returns the number of replaced requirements.
+    """
+    real_fname = os.path.realpath(fname)
+    if real_fname in files:
+        return 0
+    lines = []
+    files[real_fname] = (fname, lines)
+    log(f"Processing {fname}")
+    includes = []
+    nb_replace = 0
+    # newline="" to keep the line endings of the file
+    with open(fname, "r", encoding="UTF-8", newline="") as in_stream:
+        physical_lines = []
+        for line in in_stream:
+            physical_lines.append(line)
+            # a logical line continues on the next one when it ends with a backslash
+            if line.rstrip("\r\n").endswith("\\"):
+                continue
+            logical_line = "".join(
+                physical.rstrip("\r\n")[:-1]
+                if physical.rstrip("\r\n").endswith("\\")
+                else physical
+                for physical in physical_lines
+            )
+            code = split_requirement_comment(logical_line).strip()
+            new_line = None
+            match = _INCLUDE_RE.match(code)
+            if match:
+                includes.append(
+                    (match.group(1) in ("-c", "--constraint"), match.group(2))
+                )
+            else:
+                name = None
+                egg = _VCS_EGG_RE.match(code)
+                req = _REQUIREMENT_RE.match(code) if not code.startswith("-") else None
+                if egg:
+                    # -e git+https://...#egg=<name>
+                    name, extras, marker = egg.group(1), egg.group(2) or "", ""
+                elif req:
+                    name, extras = req.group(1), req.group(2) or ""
+                    # drop the options like --hash: they were for the released package
+                    rest, _, marker = req.group(3).partition(";")
+                    marker = re.split(r"\s--?\w", " " + marker.strip())[0].strip()
+                if name and normalize_name(name) in module_dirs:
+                    info = module_dirs[normalize_name(name)]
+                    if constraints:
+                        new_line = (
+                            f"# {name}: constraint removed for the local dependency"
+                        )
+                    else:
+                        new_line = requirement_line(
+                            name, extras, marker, info, container_mode
+                        )
+                    log(f"Replacing {name} in {fname} with {new_line}")
+                    # keep the line ending of the file
+                    last_line = physical_lines[-1]
+                    new_line += last_line[len(last_line.rstrip("\r\n")) :]
+                    nb_replace += 1
+            if new_line is None:
+                lines.append(("".join(physical_lines), logical_line, code))
+            else:
+                lines.append((new_line, new_line, None))
+            physical_lines = []
+        if physical_lines:
+            logical_line = "".join(physical_lines)
+            lines.append((logical_line, logical_line, ""))
+    for is_constraints, include in includes:
+        include_path = os.path.join(os.path.dirname(fname), include)
+        real_include = os.path.realpath(include_path)
+        if not real_include.startswith(os.path.realpath(root_dir) + os.sep):
+            log(f"Not following {include} outside of {root_dir}")
+            continue
+        if not os.path.isfile(include_path):
+            log(f"Included file {include_path} not found")
+            continue
+        nb_replace += rewrite_requirements(
+            include_path,
+            root_dir,
+            module_dirs,
+            container_mode,
+            files,
+            constraints or is_constraints,
+        )
+    return nb_replace
+
+
+def strip_hashes(text, logical_line):
+    """Return a requirements line without its --hash and --require-hashes options.
+
+    A line continued with backslashes is joined. None is returned when
+    nothing but these options is left.
+    """
+    code = split_requirement_comment(logical_line)
+    if not _HASH_OPTION_RE.search(code):
+        return text
+    ending = logical_line[len(logical_line.rstrip("\r\n")) :]
+    comment = logical_line.rstrip("\r\n")[len(code) :]
+    line = (_HASH_OPTION_RE.sub("", code) + comment).strip()
+    return line + ending if line else None
+
+
+def process_python_requirements(main_dir, dirs, container_mode, module_dirs=None):
+    """Replace modules in requirements.txt for the local dependencies.
+
+    pip checks the hashes of all the requirements or none, and the local
+    dependencies cannot have hashes. So when a replacement is done in files
+    using --hash or --require-hashes, these options are removed from all the
+    files with a warning.
+    """
     requirements_txt = os.path.join(main_dir, "requirements.txt")
-    requirements_txt_new = requirements_txt + ".new"
     if not os.path.exists(requirements_txt):
         return False
     log("requirements.txt detected")
-    module_dirs = get_modules(dirs)
+    if module_dirs is None:
+        module_dirs = get_modules(dirs)
     if len(module_dirs) == 0:
         raise ValueError("No Python modules found in the project")
 
     log(f"{module_dirs=}")
-    # replace the modules in requirements.txt
-    nb_replace = 0
-    with open(requirements_txt, "r", encoding="UTF-8") as in_stream:
-        with open(requirements_txt_new, "w", encoding="UTF-8") as out_stream:
-            for line in in_stream.readlines():
-                match = re.match(r"^\s*(\w+)", line)
-                if match and match.group(1) in module_dirs:
-                    mod = match.group(1)
-                    if container_mode:
-                        # doc at https://pip.pypa.io/en/stable/cli/pip_install/#git
-                        pkg = f"{mod} @ git+{module_dirs[mod]['fork_url']}@{module_dirs[mod]['branch']}"
-                        if "subdir" in module_dirs[mod]:
-                            pkg += (
-                                f"#egg=subdir&subdirectory={module_dirs[mod]['subdir']}"
-                            )
-                        log(f"Replacing {mod} in requirements.txt with {pkg}")
-                        out_stream.write(f"{pkg}\n")
-                    else:
-                        log(
-                            f"Replacing {mod} in requirements.txt with {module_dirs[mod]['path']}"
-                        )
-                        out_stream.write(f"-e {module_dirs[mod]['path']}\n")
-                    nb_replace += 1
-                else:
-                    out_stream.write(line)
-    os.rename(requirements_txt_new, requirements_txt)
-    return nb_replace > 0
+    # replace the modules in requirements.txt and the files it includes
+    files = {}
+    nb_replace = rewrite_requirements(
+        requirements_txt, main_dir, module_dirs, container_mode, files
+    )
+    if nb_replace == 0:
+        return False
+    hash_mode = any(
+        code and _HASH_OPTION_RE.search(code)
+        for _, lines in files.values()
+        for _, _, code in lines
+    )
+    if hash_mode:
+        log(
+            "WARNING: removing the --hash and --require-hashes options"
+            " as the local dependencies cannot be hash-checked"
+        )
+    for fname, lines in files.values():
+        texts = [
+            strip_hashes(text, logical_line) if hash_mode and code else text
+            for text, logical_line, code in lines
+        ]
+        write_if_changed(fname, "".join(text for text in texts if text is not None))
+    return True
+
+
+def split_toml_comment(line):
+    "Return the code and the comment (including #) of a TOML line."
+    pos = 0
+    while True:
+        hash_pos = line.find("#", pos)
+        if hash_pos == -1:
+            return line, ""
+        match = _TOML_STRING_RE.search(line, pos)
+        if match is None or match.start() > hash_pos:
+            return line[:hash_pos], line[hash_pos:]
+        pos = match.end()
+
+
+def bracket_depth(code):
+    "Return the number of [ and { opened minus closed in code, outside strings."
+    code = _TOML_STRING_RE.sub("", code)
+    return code.count("[") + code.count("{") - code.count("]") - code.count("}")
+
+
+def toml_string(value):
+    "Return value as a TOML basic string."
+    return '"' + value.replace("\\", "\\\\").replace('"', '\\"') + '"'
+
+
+def toml_table_name(header):
+    "Return the dotted name of a table header without quotes and spaces."
+    return ".".join(
+        part.strip().strip("\"'")
+        for part in re.findall(r'"[^"]*"|\'[^\']*\'|[^.]+', header)
+    )
+
+
+def requirement_url(info, container_mode):
+    "Return the PEP 508 direct reference URL of a local dependency."
+    if container_mode:
+        url = f"git+{info['fork_url']}@{info['branch']}"
+        if "subdir" in info:
+            url += f"#subdirectory={info['subdir']}"
+        return url
+    return pathlib.Path(info["path"]).as_uri()
+
+
+def toml_source(info, container_mode, editable=False):
+    "Return the inline table of a Poetry or uv source for a local dependency."
+    if container_mode:
+        # doc at https://python-poetry.org/docs/dependency-specification/#git-dependencies
+        pkg = f"{{ git = {toml_string(info['fork_url'])}, branch = {toml_string(info['branch'])}"
+        if "subdir" in info:
+            pkg += f", subdirectory = {toml_string(info['subdir'])}"
+        return pkg + " }"
+    if editable:
+        return f"{{ path = {toml_string(info['path'])}, editable = true }}"
+    return f"{{ path = {toml_string(info['path'])} }}"
+
+
+def rewrite_requirement_strings(code, module_dirs, container_mode, replaced):
+    "Rewrite the PEP 508 strings of code matching a local dependency."
+
+    def replace(match):
+        value = match.group(0)[1:-1]
+        if match.group(0)[0] == '"':
+            value = value.replace('\\"', '"').replace("\\\\", "\\")
+        req = _REQUIREMENT_RE.match(value)
+        if not req or normalize_name(req.group(1)) not in module_dirs:
+            return match.group(0)
+        name = req.group(1)
+        info = module_dirs[normalize_name(name)]
+        marker = req.group(3).partition(";")[2].strip()
+        new_value = (
+            f"{name}{req.group(2) or ''} @ {requirement_url(info, container_mode)}"
+        )
+        if marker:
+            new_value += f" ; {marker}"
+        replaced.append(name)
+        return toml_string(new_value)
+
+    return _TOML_STRING_RE.sub(replace, code)
 
 
-def process_python_pyproject(main_dir, dirs, container_mode):
+def toml_table_keys(content, table_name):
+    "Return the keys of a TOML table found in content."
+    keys = []
+    table = None
+    for line in content.splitlines():
+        match = _TOML_TABLE_RE.match(line)
+        if match:
+            table = toml_table_name(match.group(1))
+            continue
+        match = _TOML_KEY_RE.match(line)
+        if match and table == table_name:
+            keys.append(match.group(2).strip("\"'"))
+    return keys
+
+
+def rewrite_pyproject(content, module_dirs, container_mode):
+    """Rewrite the declarations of the local dependencies in a pyproject.toml content.
+
+    module_dirs is indexed by normalized name. The PEP 508 strings of the
+    [project] dependencies, optional-dependencies and [dependency-groups]
+    arrays are changed to direct references, and the values of the
+    [tool.poetry.*dependencies] and [tool.uv.sources] entries to path or git
+    sources. Formatting and comments are preserved.
+
+    Returns the new content and the list of the replaced names.
+    """
+    # the dependencies with a uv source are resolved by uv from the source
+    uv_sources = {
+        normalize_name(key) for key in toml_table_keys(content, "tool.uv.sources")
+    }
+    requirement_dirs = {
+        name: info for name, info in module_dirs.items() if name not in uv_sources
+    }
+    replaced = []
+    lines = []
+    table = None
+    # remaining depth of a value spanning multiple lines and what to do with its lines:
+    # rewrite the requirement strings, keep them or drop them as the value was replaced
+    depth = 0
+    value_mode = None
+    multiline_string = None
+    for line in content.splitlines(keepends=True):
+        if multiline_string:
+            if line.count(multiline_string) % 2 == 1:
+                multiline_string = None
+            lines.append(line)
+            continue
+        code, comment = split_toml_comment(line)
+        if depth > 0:
+            depth += bracket_depth(code)
+            if value_mode == "requirements":
+                line = (
+                    rewrite_requirement_strings(
+                        code, requirement_dirs, container_mode, replaced
+                    )
+                    + comment
+                )
+            if value_mode != "drop":
+                lines.append(line)
+            continue
+        for quotes in ('"""', "'''"):
+            if code.count(quotes) % 2 == 1:
+                multiline_string = quotes
+        match = _TOML_TABLE_RE.match(line)
+        if match:
+            table = toml_table_name(match.group(1))
+            lines.append(line)
+            continue
+        match = _TOML_KEY_RE.match(code)
+        if not match or multiline_string:
+            lines.append(line)
+            continue
+        key = match.group(2).strip("\"'")
+        value = match.group(4)
+        depth = bracket_depth(value)
+        value_mode = "keep"
+        if (
+            (table == "project" and key == "dependencies")
+            or table in ("project.optional-dependencies", "dependency-groups")
+        ) and value.startswith("["):
+            value_mode = "requirements"
+            line = (
+                rewrite_requirement_strings(
+                    code, requirement_dirs, container_mode, replaced
+                )
+                + comment
+            )
+        elif (
+            table is not None
+            and (_POETRY_TABLE_RE.match(table) or table == "tool.uv.sources")
+            and normalize_name(key) in module_dirs
+        ):
+            info = module_dirs[normalize_name(key)]
+            pkg = toml_source(info, container_mode, table == "tool.uv.sources")
+            log(f"Replacing {key} in pyproject.toml with {pkg}")
+            replaced.append(key)
+            # the lines of a replaced value spanning multiple lines are dropped
+            value_mode = "drop"
+            newline = line[len(line.rstrip("\r\n")) :]
+            line = (
+                f"{match.group(1)}{match.group(2)}{match.group(3)}{pkg}"
+                + (
+                    code[len(code.rstrip()) :] + comment.rstrip("\r\n")
+                    if comment and depth == 0
+                    else ""
+                )
+                + (newline or "\n")
+            )
+        lines.append(line)
+    return "".join(lines), replaced
+
+
+def update_python_locks(main_dir, names):
+    """Update the uv.lock and poetry.lock files of main_dir for the names packages only.
+
+    The other packages stay pinned to their locked versions. Set
+    DEPENDS_ON_PYTHON_LOCK to false to leave the lock files alone.
+    """
+    if os.environ.get("DEPENDS_ON_PYTHON_LOCK", "true").lower() == "false":
+        return False
+    # one name per package
+    names = list({normalize_name(name): name for name in names}.values())
+    updated = False
+    for lock_file, tool, cmd in (
+        (
+            "uv.lock",
+            "uv",
+            ["uv", "lock"]
+            + [arg for name in names for arg in ("--upgrade-package", name)],
+        ),
+        ("poetry.lock", "poetry", ["poetry", "update", "--lock"] + names),
+    ):
+        if not os.path.exists(os.path.join(main_dir, lock_file)):
+            continue
+        if shutil.which(tool) is None:
+            log(f"{lock_file} detected but {tool} is not installed, not updating it")
+            continue
+        if command(cmd, cwd=main_dir, check=False) == 0:
+            updated = True
+        else:
+            log(f"Unable to update {lock_file}")
+    return updated
+
+
+def process_python_pyproject(main_dir, dirs, container_mode, module_dirs=None):
     "Replace modules in pyproject.toml for the local dependencies."
     pyproject_toml = os.path.join(main_dir, "pyproject.toml")
-    pyproject_toml_new = pyproject_toml + ".new"
     if not os.path.exists(pyproject_toml):
         return False
     log("pyproject.toml detected")
     # get the list of python packages from local dependencies
-    module_dirs = get_modules(dirs)
+    if module_dirs is None:
+        module_dirs = get_modules(dirs)
     log(f"{module_dirs=}")
     # replace the modules in pyproject.toml
-    nb_replace = 0
     with open(pyproject_toml, "r", encoding="UTF-8") as in_stream:
-        with open(pyproject_toml_new, "w", encoding="UTF-8") as out_stream:
-            for line in in_stream.readlines():
-                match = re.match(r"^\s*(\w+)\s*=", line)
-                if match and match.group(1) in module_dirs:
-                    mod = match.group(1)
-                    if container_mode:
-                        # doc at https://python-poetry.org/docs/dependency-specification/#git-dependencies
-                        pkg = f'{mod} = {{ git = "{module_dirs[mod]["fork_url"]}", branch = "{module_dirs[mod]["branch"]}"'
-                        if "subdir" in module_dirs[mod]:
-                            pkg += f', subdirectory = "{module_dirs[mod]["subdir"]}" }}'
-                        else:
-                            pkg += " }"
-                        log(f"Replacing {mod} in pyproject.toml with {pkg}")
-                        out_stream.write(f"{pkg}\n")
-                    else:
-                        log(
-                            f"Replacing {mod} in pyproject.toml with {module_dirs[mod]['path']}"
-                        )
-                        out_stream.write(
-                            f'{mod} = {{ path = "{module_dirs[mod]["path"]}" }}\n'
-                        )
-                    nb_replace += 1
-                else:
-                    out_stream.write(line)
-    os.rename(pyproject_toml_new, pyproject_toml)
-    return nb_replace > 0
+        content, replaced = rewrite_pyproject(
+            in_stream.read(), module_dirs, container_mode
+        )
+    if not replaced:
+        return False
+    log(f"Replaced {replaced} in pyproject.toml")
+    # the lock files are stale for the replaced packages, unless an earlier
+    # run already rewrote pyproject.toml and updated them
+    if write_if_changed(pyproject_toml, content):
+        update_python_locks(main_dir, replaced)
+    return True
 
 
+@traced("processor")
 def process_python(main_dir, dirs, container_mode):
     "Process python dependencies."
+    if not any(
+        os.path.exists(os.path.join(main_dir, fname))
+        for fname in ("pyproject.toml", "requirements.txt")
+    ):
+        return False
+    # look up the names of the local dependencies once for all the files
+    module_dirs = get_modules(dirs)
     # process pyprohect.toml first because they can both be present
     # and it supposed to be the main one
     return process_python_pyproject(
-        main_dir, dirs, container_mode
-    ) or process_python_requirements(main_dir, dirs, container_mode)
+        main_dir, dirs, container_mode, module_dirs
+    ) or process_python_requirements(main_dir, dirs, container_mode, module_dirs)
 
 
 # python.py ends here
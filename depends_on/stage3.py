@@ -0,0 +1,260 @@
+"""Stage3: inject the local dependencies into the main changeset.
+
+Library used by the depends_on_stage3 script and directly by stage2.
+"""
+
+import json
+import os
+import subprocess
+
+from depends_on.ansible import process_ansible
+from depends_on.common import log
+from depends_on.golang import process_golang
+from depends_on.javascript import process_javascript
+from depends_on.python import process_python
+from depends_on.trace import span, traced
+
+# cache of the repositories found by scan_directories() in the top directory
+INDEX_FILE = ".depends-on-index.json"
+
+
+def extract_repo_name(url):
+    "Return the repository name from a git URL in the form github.com/<org>/<repo>."
+    if not url:
+        return url
+    if url.endswith(".git"):
+        url = url[:-4]
+    return "/".join(url.split("/")[2:5])
+
+
+def normalize_remote_url(origin_url):
+    "Convert an ssh remote URL to https."
+    if origin_url.startswith("git@"):
+        origin_url = origin_url.replace(":", "/", 1)
+        origin_url = origin_url.replace("git@", "https://")
+    return origin_url
+
+
+def get_remote_url(proj_dir):
+    "Return the remote URL of the git repository in proj_dir."
+    with span("git remote get-url origin", "git"):
+        origin_url = subprocess.run(
+            ["git", "remote", "get-url", "origin"],
+            cwd=proj_dir,
+            capture_output=True,
+            text=True,
+        ).stdout.strip()
+    return normalize_remote_url(origin_url)
+
+
+# True when the global or system git config rewrites URLs, computed once
+_GLOBAL_URL_REWRITES = None
+
+
+def has_global_url_rewrites():
+    "Return True if the global or system git config has url.<base>.insteadOf rules."
+    global _GLOBAL_URL_REWRITES
+    if _GLOBAL_URL_REWRITES is None:
+        with span("git config --get-regexp insteadof", "git"):
+            ret = subprocess.run(
+                [
+                    "git",
+                    "config",
+                    "--show-scope",
+                    "--get-regexp",
+                    r"^url\..*\.(push)?insteadof$",
+                ],
+                cwd=os.path.expanduser("~"),
+                capture_output=True,
+                text=True,
+            )
+        if ret.returncode == 1:
+            # no matching key
+            _GLOBAL_URL_REWRITES = False
+        elif ret.returncode == 0:
+            _GLOBAL_URL_REWRITES = any(
+                line.split("\t", 1)[0] not in ("local", "worktree")
+                for line in ret.stdout.splitlines()
+            )
+        else:
+            # unknown with this git version: let git compute the URLs
+            _GLOBAL_URL_REWRITES = True
+    return _GLOBAL_URL_REWRITES
+
+
+def parse_section(header):
+    """Return the (name, subsection) of a git config section header.
+
+    Section names are case-insensitive, subsections are case-sensitive
+    except in the deprecated [section.subsection] syntax.
+    """
+    name, _, subsection = header.partition(" ")
+    if subsection:
+        return name.lower(), subsection.strip().strip('"')
+    name, _, subsection = header.lower().partition(".")
+    return name, subsection or None
+
+
+def read_origin_url(git_config):
+    """Return the URL of the origin remote read from a git config file.
+
+    Return None when git is needed to compute it: includes and URL rewriting,
+    in this file or in the global config.
+    """
+    section = None
+    origin_url = None
+    with open(git_config, "r", encoding="UTF-8", errors="replace") as in_stream:
+        for line in in_stream:
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+            if line.startswith("["):
+                section = parse_section(line[1:].split("]", 1)[0].strip())
+                if section[0] in ("include", "includeif"):
+                    return None
+                continue
+            key, _, value = line.partition("=")
+            key = key.strip().lower()
+            if key in ("insteadof", "pushinsteadof"):
+                return None
+            if section == ("remote", "origin") and key == "url" and origin_url is None:
+                origin_url = value.strip().strip('"')
+    if origin_url is not None and has_global_url_rewrites():
+        return None
+    return origin_url
+
+
+def stat_key(fname):
+    "Return the (mtime, size) of fname or None if it doesn't exist."
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return None
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def load_index(index_fname):
+    "Load the repository index saved by a previous call of directories."
+    try:
+        with open(index_fname, "r", encoding="UTF-8") as in_stream:
+            return json.load(in_stream)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_index(index_fname, index):
+    "Save the repository index, ignoring errors as it is only a cache."
+    tmp_fname = f"{index_fname}.{os.getpid()}"
+    try:
+        with open(tmp_fname, "w", encoding="UTF-8") as out_stream:
+            json.dump(index, out_stream)
+        os.replace(tmp_fname, index_fname)
+    except OSError as exc:
+        log(f"Unable to save {index_fname}: {exc}")
+
+
+def scan_repository(top_dir, key_dir, config_key, json_key):
+    "Return the index entry of the git repository in key_dir."
+    info = {"top_dir": top_dir, "path": top_dir}
+    if json_key:
+        with open(os.path.join(key_dir, "depends-on.json"), "r") as json_stream:
+            data = json.load(json_stream)
+            info.update(data)
+            if "subdir" in data:
+                info["path"] = os.path.join(key_dir, data["subdir"])
+    origin_url = read_origin_url(os.path.join(key_dir, ".git", "config"))
+    if origin_url is None:
+        origin_url = get_remote_url(key_dir)
+    return {
+        "config": config_key,
+        "json": json_key,
+        "repo_name": extract_repo_name(normalize_remote_url(origin_url)),
+        "info": info,
+    }
+
+
+def scan_directories(top_dir):
+    """Return the index of all the git repositories in top_dir: {dir name: entry}.
+
+    entry:
+    - config, json: mtime and size of .git/config and depends-on.json
+    - repo_name: the repository name in the form github.com/<org>/<repo>
+    - info: the dict info returned by directories
+
+    The index is saved in INDEX_FILE in top_dir and only the repositories
+    whose .git/config or depends-on.json changed are read again by the next
+    calls. As the paths of the entries are derived from top_dir, the saved
+    index is only used with the same top_dir spelling.
+    """
+    index_fname = os.path.join(top_dir, INDEX_FILE)
+    saved = load_index(index_fname)
+    old_index = saved.get("repos", {}) if saved.get("top_dir") == top_dir else {}
+    index = {}
+    with os.scandir(top_dir) as dir_entries:
+        for dir_entry in dir_entries:
+            if not dir_entry.is_dir():
+                continue
+            key_dir = os.path.join(top_dir, dir_entry.name)
+            # a .git directory always has a config file
+            config_key = stat_key(os.path.join(key_dir, ".git", "config"))
+            if config_key is None:
+                continue
+            json_key = stat_key(os.path.join(key_dir, "depends-on.json"))
+            entry = old_index.get(dir_entry.name)
+            if (
+                entry is None
+                or entry["config"] != config_key
+                or entry["json"] != json_key
+            ):
+                entry = scan_repository(top_dir, key_dir, config_key, json_key)
+            index[dir_entry.name] = entry
+    if index != old_index:
+        save_index(index_fname, {"top_dir": top_dir, "repos": index})
+    return index
+
+
+def directories(top_dir, main_dir, index=None):
+    """Return a dict of {repo_name: <dict info>} for all git repositories in top_dir.
+
+    dict info:
+    - top_dir: the top directory of the repository
+    - path: the path to the module in the repository
+    - subdir: the subdirectory of the module in the repository (optional)
+
+    index is the result of scan_directories(top_dir), computed if not passed.
+    """
+    if index is None:
+        index = scan_directories(top_dir)
+    ret = {}
+    for name, entry in index.items():
+        if os.path.join(top_dir, name) != main_dir:
+            ret[entry["repo_name"]] = entry["info"]
+    return ret
+
+
+def detect_container_mode(main_dir):
+    "Return True if main_dir contains a Dockerfile or a Containerfile."
+    return os.path.exists(os.path.join(main_dir, "Dockerfile")) or os.path.exists(
+        os.path.join(main_dir, "Containerfile")
+    )
+
+
+@traced("stage", "stage3")
+def run_stage3(main_dir, top_dir, index=None):
+    """Inject the local dependencies found in top_dir into main_dir.
+
+    index is the result of scan_directories(top_dir), to share it between
+    several calls.
+    """
+    dirs = directories(top_dir, main_dir, index)
+    log(f"{main_dir=} {top_dir=} {dirs=}")
+
+    container_mode = detect_container_mode(main_dir)
+    log(f"{container_mode=}")
+    process_golang(main_dir, dirs, container_mode)
+    process_python(main_dir, dirs, container_mode)
+    process_javascript(main_dir, dirs, container_mode)
+    process_ansible(main_dir, dirs, container_mode)
+
+
+# stage3.py ends here
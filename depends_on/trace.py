@@ -0,0 +1,143 @@
+"""Timing spans of the stages, commands, HTTP requests and processors.
+
+When DEPENDS_ON_TRACE is set to a file name, each span is appended to this
+file as one Chrome trace event per line (JSONL). Wrapping the lines in [ ]
+gives a file loadable in chrome://tracing or https://ui.perfetto.dev.
+"""
+
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+
+
+def get_trace_file():
+    """Return the absolute trace file name or None if tracing is disabled.
+
+    A relative name is resolved once, at the start of the stage, and stored
+    back in the environment as the stages change directory between the
+    repositories.
+    """
+    fname = os.environ.get("DEPENDS_ON_TRACE")
+    if not fname:
+        return None
+    if not os.path.isabs(fname):
+        fname = os.path.abspath(fname)
+        os.environ["DEPENDS_ON_TRACE"] = fname
+    return fname
+
+
+# resolve a relative trace file name before any change of directory
+get_trace_file()
+
+
+def write_event(fname, event):
+    "Append an event to the trace file."
+    line = (json.dumps(event) + "\n").encode("utf-8")
+    # one write on an O_APPEND descriptor to not mix lines between processes
+    fd = os.open(fname, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0o644)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def span(name, category, **args):
+    "Time the enclosed block and record it in the trace file if tracing is enabled."
+    fname = get_trace_file()
+    if not fname:
+        yield
+        return
+    start = time.time()
+    start_counter = time.perf_counter()
+    try:
+        yield
+    finally:
+        write_event(
+            fname,
+            {
+                "name": name,
+                "cat": category,
+                "ph": "X",
+                "ts": int(start * 1e6),
+                "dur": int((time.perf_counter() - start_counter) * 1e6),
+                "pid": os.getpid(),
+                "tid": threading.get_native_id(),
+                "args": args,
+            },
+        )
+
+
+def traced(category, name=None):
+    "Decorator recording each call of the function as a span named name or like the function."
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name or func.__name__, category):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def load_events(fname):
+    "Return the list of events of a trace file."
+    events = []
+    with open(fname, "r", encoding="UTF-8") as in_stream:
+        for line in in_stream:
+            line = line.strip()
+            if line:
+                events.append(json.loads(line))
+    return events
+
+
+def format_summary(events, nb_slowest=10):
+    "Return a markdown summary of the events: time per category and slowest spans."
+    categories = {}
+    for event in events:
+        count, total, longest = categories.get(event["cat"], (0, 0, 0))
+        categories[event["cat"]] = (
+            count + 1,
+            total + event["dur"],
+            max(longest, event["dur"]),
+        )
+    lines = [
+        "### Depends-On timings",
+        "",
+        "| Category | Count | Total (s) | Max (s) |",
+        "| --- | ---: | ---: | ---: |",
+    ]
+    for category, (count, total, longest) in sorted(
+        categories.items(), key=lambda item: -item[1][1]
+    ):
+        lines.append(
+            f"| {category} | {count} | {total / 1e6:.2f} | {longest / 1e6:.2f} |"
+        )
+    lines += [
+        "",
+        "| Slowest spans | Category | Duration (s) |",
+        "| --- | --- | ---: |",
+    ]
+    for event in sorted(events, key=lambda event: -event["dur"])[:nb_slowest]:
+        name = event["name"].replace("|", "\\|")
+        lines.append(f"| {name} | {event['cat']} | {event['dur'] / 1e6:.2f} |")
+    return "\n".join(lines) + "\n"
+
+
+def write_summary():
+    "Append the summary of the trace file to the GitHub step summary if both are set."
+    fname = get_trace_file()
+    summary_fname = os.environ.get("GITHUB_STEP_SUMMARY")
+    if not fname or not summary_fname or not os.path.exists(fname):
+        return False
+    with open(summary_fname, "a", encoding="UTF-8") as out_stream:
+        out_stream.write(format_summary(load_events(fname)))
+    return True
+
+
+# trace.py ends here
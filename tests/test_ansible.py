@@ -1,4 +1,6 @@
+import os
 import pathlib
+import subprocess
 
 import pytest
 import yaml
@@ -201,7 +203,7 @@ collections:
         ),
     ],
 )
-def test_substitute_collection(
+def test_rewrite_requirements_collection(
     collection_name: str,
     requirements_content: str,
     info: dict,
@@ -209,15 +211,219 @@ def test_substitute_collection(
     return_code: bool,
     expected_requirements: str,
 ):
-    requirements = yaml.safe_load(requirements_content)
-    assert requirements is not None
-    result = ansible.substitute_collection(
-        collection_name=collection_name,
-        info=info,
-        requirements=requirements,
-        container_mode=container_mode,
+    index = {"collections": {}, "roles": {}, "repos": {}}
+    if collection_name:
+        index["collections"][collection_name] = info
+    content, result, includes = ansible.rewrite_requirements(
+        requirements_content, index, container_mode
     )
 
     assert result == return_code
+    assert includes == []
     if result != 0:
-        assert requirements == expected_requirements
+        assert yaml.safe_load(content) == expected_requirements
+    else:
+        assert content == requirements_content
+
+
+def test_rewrite_requirements_inner_comments():
+    index = {
+        "collections": {"my.collection": {"path": "/src"}},
+        "roles": {},
+        "repos": {},
+    }
+    content = """collections:
+  - name: my.collection  # local
+    # any version
+    version: "#1"  # quoted
+  - {name: my.collection, # flow
+     version: "1.0"}
+"""
+
+    assert ansible.rewrite_requirements(content, index, False) == (
+        """collections:
+  - {name: my.collection, source: /src, type: dir}  # quoted
+    # local
+    # any version
+  - {name: my.collection, source: /src, type: dir}
+    # flow
+""",
+        2,
+        [],
+    )
+
+
+@pytest.fixture
+def ansible_project(tmp_path, monkeypatch):
+    "Main project with requirements files using a local collection and a local role."
+    collection = tmp_path / "collection"
+    collection.mkdir()
+    (collection / "galaxy.yml").write_text("namespace: my\nname: collection\n")
+    role = tmp_path / "role"
+    (role / "meta").mkdir(parents=True)
+    (role / "meta" / "main.yml").write_text(
+        "galaxy_info:\n  namespace: my\n  role_name: role\n"
+    )
+    main_dir = tmp_path / "main"
+    (main_dir / "roles" / "local" / "meta").mkdir(parents=True)
+    (main_dir / "requirements.yml").write_text(
+        """---
+# collections of the project
+collections:
+  # the local one
+  - name: my.collection
+    version: ">=1.0.0"
+  - community.docker
+roles:
+  - src: https://github.com/org/role.git
+    version: v1.0
+  # other roles
+  - include: roles/extra.yml
+"""
+    )
+    (main_dir / "roles" / "extra.yml").write_text(
+        "- my.role\n- src: geerlingguy.docker\n- include: ../../outside.yml\n"
+    )
+    (main_dir / "roles" / "local" / "meta" / "requirements.yml").write_text(
+        "collections: ['my.collection', other.collection]\n"
+    )
+    (tmp_path / "outside.yml").write_text("- my.role\n")
+    dirs = {
+        "github.com/org/collection": {
+            "path": str(collection),
+            "fork_url": "https://github.com/fork/collection",
+            "branch": "feature",
+        },
+        "github.com/org/role": {
+            "path": str(role),
+            "fork_url": "https://github.com/fork/role",
+            "branch": "feature",
+        },
+    }
+    monkeypatch.setattr(ansible, "_NAME_CACHE", {})
+    return main_dir, dirs
+
+
+@pytest.mark.parametrize(
+    "container_mode, collection, role",
+    [
+        (
+            False,
+            "{{name: my.collection, source: {path}/collection, type: dir}}",
+            "{{src: 'git+file://{path}/role'}}",
+        ),
+        (
+            True,
+            "{{name: 'https://github.com/fork/collection', version: feature, type: git}}",
+            "{{src: 'git+https://github.com/fork/role', version: feature}}",
+        ),
+    ],
+)
+def test_process_ansible(ansible_project, container_mode, collection, role):
+    main_dir, dirs = ansible_project
+    path = main_dir.parent
+    collection = collection.format(path=path)
+    named_role = "{name: my.role, " + role.format(path=path)[1:]
+    role = role.format(path=path)
+
+    assert ansible.process_ansible(str(main_dir), dirs, container_mode)
+
+    assert (
+        (main_dir / "requirements.yml").read_text()
+        == f"""---
+# collections of the project
+collections:
+  # the local one
+  - {collection}
+  - community.docker
+roles:
+  - {role}
+  # other roles
+  - include: roles/extra.yml
+"""
+    )
+    assert (main_dir / "roles" / "extra.yml").read_text() == (
+        f"- {named_role}\n- src: geerlingguy.docker\n- include: ../../outside.yml\n"
+    )
+    assert (main_dir / "roles" / "local" / "meta" / "requirements.yml").read_text() == (
+        f"collections: [{collection}, other.collection]\n"
+    )
+    assert (path / "outside.yml").read_text() == "- my.role\n"
+    # the rewritten files are still valid requirements
+    requirements = yaml.safe_load((main_dir / "requirements.yml").read_text())
+    assert requirements["collections"][0] == yaml.safe_load(collection)
+
+
+def test_process_ansible_unchanged(ansible_project, monkeypatch):
+    main_dir, dirs = ansible_project
+    assert ansible.process_ansible(str(main_dir), dirs, False)
+    content = (main_dir / "requirements.yml").read_text()
+    mtime = (main_dir / "requirements.yml").stat().st_mtime_ns
+
+    # the names are looked up once
+    def fail_lookup(repo_dir):
+        pytest.fail("looked up again")
+
+    monkeypatch.setattr(ansible, "get_collection_name", fail_lookup)
+    ansible.process_ansible(str(main_dir), dirs, False)
+    assert (main_dir / "requirements.yml").read_text() == content
+    assert (main_dir / "requirements.yml").stat().st_mtime_ns == mtime
+
+
+def test_process_ansible_collection_cache(ansible_project, tmp_path, monkeypatch):
+    main_dir, dirs = ansible_project
+    collection = pathlib.Path(dirs["github.com/org/collection"]["path"])
+    for cmd in (
+        ["git", "init", "-q"],
+        ["git", "add", "."],
+        ["git", "-c", "user.name=t", "-c", "user.email=t@t", "commit", "-q", "-m", "."],
+    ):
+        subprocess.run(cmd, cwd=collection, check=True)
+    # saved by stage2 in the checkouts of the dependencies
+    (collection / "depends-on.json").write_text("{}\n")
+    tree_hash = subprocess.run(
+        ["git", "rev-parse", "HEAD^{tree}"],
+        cwd=collection,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.strip()
+    # fake ansible-galaxy writing the tarball in --output-path
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls"
+    script = bin_dir / "ansible-galaxy"
+    script.write_text(
+        f'#!/bin/sh\necho "$@" >> {calls}\necho built > "$4/my-collection-1.0.0.tar.gz"\n'
+    )
+    script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setenv("DEPENDS_ON_ANSIBLE_CACHE_DIR", str(cache_dir))
+    monkeypatch.setattr(ansible, "_TARBALLS", {})
+    tarball = cache_dir / f"my.collection-{tree_hash}.tar.gz"
+
+    assert ansible.process_ansible(str(main_dir), dirs, False)
+
+    requirements = yaml.safe_load((main_dir / "requirements.yml").read_text())
+    assert requirements["collections"][0] == {"name": str(tarball), "type": "file"}
+    assert tarball.read_text() == "built\n"
+    assert os.listdir(cache_dir) == [tarball.name]
+    assert len(calls.read_text().splitlines()) == 1
+
+    # the next run uses the cached tarball
+    (main_dir / "requirements.yml").write_text("collections:\n  - my.collection\n")
+    monkeypatch.setattr(ansible, "_TARBALLS", {})
+    assert ansible.process_ansible(str(main_dir), dirs, False)
+    assert (main_dir / "requirements.yml").read_text() == (
+        f"collections:\n  - {{name: {tarball}, type: file}}\n"
+    )
+    assert len(calls.read_text().splitlines()) == 1
+
+    # local changes are not cached
+    (collection / "galaxy.yml").write_text("namespace: my\nname: collection\n# x\n")
+    monkeypatch.setattr(ansible, "_TARBALLS", {})
+    (main_dir / "requirements.yml").write_text("collections:\n  - my.collection\n")
+    assert ansible.process_ansible(str(main_dir), dirs, False)
+    requirements = yaml.safe_load((main_dir / "requirements.yml").read_text())
+    assert requirements["collections"][0]["type"] == "dir"
@@ -1,8 +1,12 @@
 import pathlib
+import shutil
+import subprocess
 
 import pytest
 
+import depends_on.common as common
 import depends_on.golang as go
+import depends_on.trace as trace
 
 
 @pytest.mark.parametrize(
@@ -281,3 +285,321 @@ def test_get_modules(tmp_path: pathlib.Path, go_mod_content, expected_modules):
 
     assert result is not None
     assert result == expected_modules
+
+
+def write_go_mod(go_dir, requires):
+    go_dir.mkdir()
+    (go_dir / "go.mod").write_text(
+        "module github.com/org/main\n\ngo 1.21\n\nrequire (\n"
+        + "".join(f"\t{mod} v1.0.0\n" for mod in requires)
+        + ")\n"
+    )
+
+
+@pytest.mark.parametrize(
+    "tidy_mode, expected_calls",
+    [
+        ("true", [["mod", "tidy"]]),
+        ("false", []),
+        ("defer", []),
+    ],
+)
+def test_process_golang_batch(tmp_path, monkeypatch, tidy_mode, expected_calls):
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a", "github.com/org/b", "github.com/x/y"])
+    dirs = {
+        "github.com/org/a": {"path": "/src/a"},
+        "github.com/org/b": {"path": "/src/b"},
+    }
+    calls = []
+    monkeypatch.setattr(
+        go, "run_go", lambda args, cwd=None, env=None: calls.append(args)
+    )
+    monkeypatch.setattr(go, "_DEFERRED_TIDY", [])
+    monkeypatch.setenv("DEPENDS_ON_GO_TIDY", tidy_mode)
+
+    assert go.process_golang(str(main_dir), dirs, False)
+
+    assert (
+        calls
+        == [
+            [
+                "mod",
+                "edit",
+                "-replace",
+                "github.com/org/a=/src/a",
+                "-replace",
+                "github.com/org/b=/src/b",
+            ]
+        ]
+        + expected_calls
+    )
+    assert go._DEFERRED_TIDY == ([str(main_dir)] if tidy_mode == "defer" else [])
+
+    go.run_deferred_tidy()
+    assert go._DEFERRED_TIDY == []
+    if tidy_mode == "defer":
+        assert calls[-1] == ["mod", "tidy"]
+
+
+def test_process_golang_go_mod_edit(tmp_path, monkeypatch):
+    if shutil.which("go") is None:
+        pytest.skip("go not installed")
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a", "github.com/org/b"])
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "go.mod").write_text(f"module github.com/org/{name}\n")
+    dirs = {
+        f"github.com/org/{name}": {"path": str(tmp_path / name)} for name in ("a", "b")
+    }
+    monkeypatch.setenv("DEPENDS_ON_GO_TIDY", "false")
+
+    assert go.process_golang(str(main_dir), dirs, False)
+
+    go_mod = (main_dir / "go.mod").read_text()
+    assert f"github.com/org/a => {tmp_path / 'a'}" in go_mod
+    assert f"github.com/org/b => {tmp_path / 'b'}" in go_mod
+
+
+def test_parse_mod_content():
+    model = go.parse_mod_content(
+        """module "example.com/main" // the main module
+go 1.21
+toolchain go1.21.5
+require (
+	example.com/a v1.0.0 // indirect
+	example.com/b v1.2.0 // pinned
+)
+replace example.com/b => ../b
+replace (
+	// old fork
+	example.com/c v1.0.0 => example.com/fork/c v1.1.0
+)
+exclude example.com/d v0.1.0
+retract [v1.0.0, v1.0.5] // broken
+use ./tools
+"""
+    )
+    assert model["module"] == "example.com/main"
+    assert model["go"] == "1.21"
+    assert model["toolchain"] == "go1.21.5"
+    assert model["require"] == [
+        {"path": "example.com/a", "version": "v1.0.0", "indirect": True},
+        {"path": "example.com/b", "version": "v1.2.0", "indirect": False},
+    ]
+    assert model["replace"] == [
+        {
+            "old_path": "example.com/b",
+            "old_version": None,
+            "new_path": "../b",
+            "new_version": None,
+        },
+        {
+            "old_path": "example.com/c",
+            "old_version": "v1.0.0",
+            "new_path": "example.com/fork/c",
+            "new_version": "v1.1.0",
+        },
+    ]
+    assert model["exclude"] == [{"path": "example.com/d", "version": "v0.1.0"}]
+    assert model["retract"] == [["[v1.0.0,", "v1.0.5]"]]
+    assert model["use"] == [{"path": "./tools"}]
+    assert go.get_replacement(model, "example.com/b") == ("../b", None)
+    assert go.get_replacement(model, "example.com/c") is None
+
+
+def test_parse_mod_file_cache(tmp_path, monkeypatch):
+    go_mod = tmp_path / "go.mod"
+    go_mod.write_text("module example.com/main\n")
+    monkeypatch.setattr(go, "_MOD_FILE_CACHE", {})
+
+    model = go.parse_mod_file(go_mod)
+    assert go.parse_mod_file(go_mod) is model
+
+    go_mod.write_text("module example.com/other\n")
+    assert go.parse_mod_file(go_mod)["module"] == "example.com/other"
+
+
+def test_process_golang_already_replaced(tmp_path, monkeypatch):
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a", "github.com/org/b"])
+    with open(main_dir / "go.mod", "a") as out_stream:
+        out_stream.write("replace github.com/org/a => /src/a\n")
+    dirs = {
+        "github.com/org/a": {"path": "/src/a"},
+        "github.com/org/b": {"path": "/src/b"},
+    }
+    calls = []
+    monkeypatch.setattr(
+        go, "run_go", lambda args, cwd=None, env=None: calls.append(args)
+    )
+    monkeypatch.setenv("DEPENDS_ON_GO_TIDY", "true")
+
+    assert go.process_golang(str(main_dir), dirs, False)
+    assert calls == [
+        ["mod", "edit", "-replace", "github.com/org/b=/src/b"],
+        ["mod", "tidy"],
+    ]
+
+    calls.clear()
+    assert not go.process_golang(
+        str(main_dir), {"github.com/org/a": dirs["github.com/org/a"]}, False
+    )
+    assert calls == []
+
+
+def test_process_golang_work_mode(tmp_path, monkeypatch):
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a", "github.com/org/b"])
+    go_mod = (main_dir / "go.mod").read_text()
+    dirs = {"github.com/org/a": {"path": "/src/a"}}
+    calls = []
+    monkeypatch.setattr(
+        go, "run_go", lambda args, cwd=None, env=None: calls.append(args)
+    )
+    monkeypatch.setenv("DEPENDS_ON_GO_MODE", "work")
+
+    assert go.process_golang(str(main_dir), dirs, False)
+    assert (main_dir / "go.work").read_text() == "go 1.21\n\nuse (\n\t.\n\t/src/a\n)\n"
+
+    # only the new dependencies are added on the next runs
+    assert not go.process_golang(str(main_dir), dirs, False)
+    dirs["github.com/org/b"] = {"path": "/src/b"}
+    assert go.process_golang(str(main_dir), dirs, False)
+    model = go.parse_mod_file(main_dir / "go.work")
+    assert [use["path"] for use in model["use"]] == [".", "/src/a", "/src/b"]
+
+    assert (main_dir / "go.mod").read_text() == go_mod
+    assert calls == []
+
+
+def test_process_golang_work_mode_versions(tmp_path, monkeypatch):
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a", "github.com/org/b"])
+    for name, header in (
+        ("a", "go 1.22\ntoolchain go1.22.3\n"),
+        ("b", "go 1.21.5\n"),
+    ):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "go.mod").write_text(
+            f"module github.com/org/{name}\n\n{header}"
+        )
+    monkeypatch.setenv("DEPENDS_ON_GO_MODE", "work")
+
+    dirs = {"github.com/org/b": {"path": str(tmp_path / "b")}}
+    assert go.process_golang(str(main_dir), dirs, False)
+    assert (main_dir / "go.work").read_text() == (
+        f"go 1.21.5\n\nuse (\n\t.\n\t{tmp_path / 'b'}\n)\n"
+    )
+
+    # an existing go.work is raised to the versions of the new modules
+    dirs["github.com/org/a"] = {"path": str(tmp_path / "a")}
+    assert go.process_golang(str(main_dir), dirs, False)
+    model = go.parse_mod_file(main_dir / "go.work")
+    assert model["go"] == "1.22"
+    assert model["toolchain"] == "go1.22.3"
+    assert [use["path"] for use in model["use"]] == [
+        ".",
+        str(tmp_path / "b"),
+        str(tmp_path / "a"),
+    ]
+
+
+def test_process_golang_work_mode_go(tmp_path, monkeypatch):
+    if shutil.which("go") is None:
+        pytest.skip("go not installed")
+    main_dir = tmp_path / "main"
+    main_dir.mkdir()
+    (main_dir / "go.mod").write_text(
+        "module github.com/org/main\n\ngo 1.20\n\nrequire github.com/org/a v1.0.0\n"
+    )
+    (main_dir / "main.go").write_text(
+        'package main\n\nimport "github.com/org/a"\n\nfunc main() { a.Hello() }\n'
+    )
+    (tmp_path / "a").mkdir()
+    (tmp_path / "a" / "go.mod").write_text("module github.com/org/a\n\ngo 1.21.0\n")
+    (tmp_path / "a" / "a.go").write_text("package a\n\nfunc Hello() {}\n")
+    monkeypatch.setenv("DEPENDS_ON_GO_MODE", "work")
+    monkeypatch.setenv("GOFLAGS", "")
+    monkeypatch.setenv("GOPROXY", "off")
+    monkeypatch.setenv("GOTOOLCHAIN", "local")
+    monkeypatch.delenv("GOWORK", raising=False)
+
+    assert go.process_golang(
+        str(main_dir), {"github.com/org/a": {"path": str(tmp_path / "a")}}, False
+    )
+    subprocess.run(["go", "build", "./..."], cwd=main_dir, check=True)
+
+
+@pytest.mark.parametrize(
+    "mod, major",
+    [
+        ("github.com/org/a", 0),
+        ("github.com/org/a/v2", 2),
+        ("github.com/org/a/sub/v10", 10),
+        ("gopkg.in/yaml.v3", 3),
+        ("github.com/org/a.v3", 0),
+    ],
+)
+def test_get_major_version(mod, major):
+    assert go.get_major_version(mod) == major
+
+
+def test_resolve_pseudo_version(tmp_path, monkeypatch):
+    fork = tmp_path / "fork"
+    subprocess.run(["git", "init", "--quiet", "-b", "feature", str(fork)], check=True)
+    monkeypatch.setenv("GIT_COMMITTER_DATE", "2024-05-06T07:08:09Z")
+    subprocess.run(
+        [
+            "git",
+            "-c",
+            "user.name=test",
+            "-c",
+            "user.email=test@localhost",
+            "commit",
+            "--quiet",
+            "--allow-empty",
+            "-m",
+            "feature",
+        ],
+        cwd=fork,
+        check=True,
+    )
+    sha = subprocess.run(
+        ["git", "rev-parse", "HEAD"], cwd=fork, capture_output=True, text=True
+    ).stdout.strip()
+    info = {"fork_url": str(fork), "branch": "feature", "path": str(fork)}
+    trace_file = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("DEPENDS_ON_TRACE", str(trace_file))
+    # like a Gitlab URL with a token
+    monkeypatch.setattr(common, "_SENSITIVE_STRINGS", [str(fork)])
+
+    assert (
+        go.resolve_pseudo_version("github.com/org/a/v2", info)
+        == f"v2.0.0-20240506070809-{sha[:12]}"
+    )
+    assert [event["name"] for event in trace.load_events(trace_file)] == [
+        "git ls-remote *** feature",
+        f"git show -s --format=%ct {sha}",
+    ]
+    monkeypatch.delenv("DEPENDS_ON_TRACE")
+    assert (
+        go.resolve_pseudo_version("github.com/org/a", dict(info, branch="missing"))
+        is None
+    )
+
+    calls = []
+    monkeypatch.setattr(
+        go, "run_go", lambda args, cwd=None, env=None: calls.append(args)
+    )
+    monkeypatch.setenv("DEPENDS_ON_GO_PIN", "true")
+    main_dir = tmp_path / "main"
+    write_go_mod(main_dir, ["github.com/org/a"])
+    assert go.process_golang(str(main_dir), {"github.com/org/a": info}, True)
+    assert calls[0] == [
+        "mod",
+        "edit",
+        "-replace",
+        f"github.com/org/a={fork}@v0.0.0-20240506070809-{sha[:12]}",
+    ]
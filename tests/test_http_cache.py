@@ -0,0 +1,62 @@
+import contextlib
+import os
+
+import depends_on.http_cache as http_cache
+
+
+def test_cache_key():
+    key = http_cache.cache_key("https://api/x", {"Authorization": "token secret"})
+    assert key == http_cache.cache_key(
+        "https://api/x", {"Authorization": "token secret"}
+    )
+    assert key != http_cache.cache_key(
+        "https://api/x", {"Authorization": "token other"}
+    )
+    assert key != http_cache.cache_key("https://api/y", {})
+    assert "secret" not in key
+
+
+def test_store_load(tmp_path):
+    assert http_cache.load(tmp_path, "missing") is None
+    http_cache.store(tmp_path, "key", "https://api/x", "{}", etag='"abc"')
+    entry = http_cache.load(tmp_path, "key")
+    assert entry["body"] == "{}"
+    assert entry["etag"] == '"abc"'
+    assert http_cache.is_fresh(entry, 60)
+    assert not http_cache.is_fresh(entry, 0)
+
+
+def test_evict(tmp_path):
+    for idx in range(4):
+        http_cache.store(tmp_path, f"key{idx}", "https://api/x", "x" * 1000)
+        os.utime(tmp_path / f"key{idx}.json", (idx, idx))
+    # key0 is the least recently used until it is loaded again
+    http_cache.load(tmp_path, "key0")
+    size = os.path.getsize(tmp_path / "key0.json")
+    size += os.path.getsize(tmp_path / "key3.json")
+
+    assert http_cache.evict(tmp_path, size) == 2
+    assert sorted(os.listdir(tmp_path)) == ["key0.json", "key3.json"]
+
+
+def test_evict_removed_entry(tmp_path, monkeypatch):
+    for idx in range(3):
+        http_cache.store(tmp_path, f"key{idx}", "https://api/x", "x" * 1000)
+        os.utime(tmp_path / f"key{idx}.json", (idx, idx))
+    size = os.path.getsize(tmp_path / "key2.json")
+    scandir = os.scandir
+
+    @contextlib.contextmanager
+    def racy_scandir(path):
+        with scandir(path) as it:
+            dir_entries = list(it)
+        # another job removes an entry between scandir and stat
+        os.unlink(tmp_path / "key1.json")
+        yield iter(dir_entries)
+
+    monkeypatch.setattr(http_cache.os, "scandir", racy_scandir)
+    assert http_cache.evict(tmp_path, size) == 1
+    assert sorted(os.listdir(tmp_path)) == ["key2.json"]
+
+
+# test_http_cache.py ends here
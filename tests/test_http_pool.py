@@ -0,0 +1,85 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError
+from urllib.request import Request
+
+import pytest
+
+import depends_on.http_pool as http_pool
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    connections = []
+
+    def setup(self):
+        super().setup()
+        self.connections.append(self.client_address)
+
+    def do_GET(self):
+        if self.path == "/redirect":
+            self.send_response(301)
+            self.send_header("Location", "/ok")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        status = 200 if self.path == "/ok" else 404
+        content = self.headers.get("Authorization", "none").encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server(monkeypatch):
+    for var in ("http_proxy", "HTTP_PROXY", "https_proxy", "HTTPS_PROXY"):
+        monkeypatch.delenv(var, raising=False)
+    Handler.connections = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    thread = threading.Thread(
+        target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True
+    )
+    thread.start()
+    yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    http_pool.close_all()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_urlopen_reuses_connections(server):
+    for _ in range(3):
+        req = Request(f"{server}/ok", headers={"Authorization": "token x"})
+        with http_pool.urlopen(req) as response:
+            assert response.read() == b"token x"
+            assert response.status == 200
+    assert len(Handler.connections) == 1
+
+
+def test_urlopen_redirect(server):
+    with http_pool.urlopen(Request(f"{server}/redirect")) as response:
+        assert response.read() == b"none"
+    assert len(Handler.connections) == 1
+
+
+def test_urlopen_error(server):
+    with pytest.raises(HTTPError) as exc_info:
+        http_pool.urlopen(Request(f"{server}/missing"))
+    assert exc_info.value.code == 404
+
+
+def test_urlopen_stale_connection(server):
+    with http_pool.urlopen(Request(f"{server}/ok")) as response:
+        response.read()
+    # simulate the server closing the idle connection
+    for idle_connections in http_pool._IDLE_CONNECTIONS.values():
+        for connection in idle_connections:
+            connection.sock.close()
+    with http_pool.urlopen(Request(f"{server}/ok")) as response:
+        assert response.read() == b"none"
+
+
+# test_http_pool.py ends here
@@ -0,0 +1,330 @@
+import json
+import shutil
+import subprocess
+
+import pytest
+import yaml
+
+import depends_on.javascript as javascript
+
+
+def write_json(path, data):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(json.dumps(data, indent=2) + "\n")
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    "Main project with a workspace package depending on a local library."
+    write_json(tmp_path / "lib" / "package.json", {"name": "lib", "version": "2.0.0"})
+    main_dir = tmp_path / "main"
+    write_json(
+        main_dir / "package.json",
+        {
+            "name": "main",
+            "version": "1.0.0",
+            "workspaces": ["packages/*"],
+            "dependencies": {"lib": "^1.0.0", "other": "^1.0.0"},
+        },
+    )
+    write_json(
+        main_dir / "packages" / "ws" / "package.json",
+        {
+            "name": "ws",
+            "version": "1.0.0",
+            "peerDependencies": {"lib": "^1.0.0"},
+            "optionalDependencies": {"other": "^1.0.0"},
+        },
+    )
+    dirs = {
+        "github.com/org/lib": {
+            "path": str(tmp_path / "lib"),
+            "fork_url": "https://github.com/fork/lib",
+            "branch": "feature",
+        }
+    }
+    return main_dir, dirs
+
+
+@pytest.mark.parametrize(
+    "container_mode, expected_spec",
+    [
+        (False, "file:{lib}"),
+        (True, "git+https://github.com/fork/lib#feature"),
+    ],
+)
+def test_process_javascript_workspaces(workspace, container_mode, expected_spec):
+    main_dir, dirs = workspace
+    expected_spec = expected_spec.format(lib=dirs["github.com/org/lib"]["path"])
+
+    assert javascript.process_javascript(str(main_dir), dirs, container_mode)
+
+    package = json.loads((main_dir / "package.json").read_text())
+    assert package["dependencies"] == {"lib": expected_spec, "other": "^1.0.0"}
+    ws_package = json.loads((main_dir / "packages" / "ws" / "package.json").read_text())
+    assert ws_package["peerDependencies"] == {"lib": expected_spec}
+    assert ws_package["optionalDependencies"] == {"other": "^1.0.0"}
+
+
+@pytest.mark.parametrize("container_mode", [False, True])
+def test_patch_package_lock(workspace, container_mode):
+    main_dir, dirs = workspace
+    write_json(
+        main_dir / "package-lock.json",
+        {
+            "name": "main",
+            "lockfileVersion": 3,
+            "packages": {
+                "": {
+                    "name": "main",
+                    "dependencies": {"lib": "^1.0.0", "other": "^1.0.0"},
+                },
+                "node_modules/lib": {"version": "1.0.0", "resolved": "https://r/lib"},
+                "node_modules/lib/node_modules/dep": {"version": "1.0.0"},
+                "node_modules/other": {
+                    "version": "1.0.0",
+                    "resolved": "https://r/other",
+                },
+                "node_modules/ws": {"resolved": "packages/ws", "link": True},
+                "packages/ws": {
+                    "version": "1.0.0",
+                    "peerDependencies": {"lib": "^1.0.0"},
+                },
+            },
+        },
+    )
+
+    assert javascript.process_javascript(str(main_dir), dirs, container_mode)
+
+    lock = json.loads((main_dir / "package-lock.json").read_text())
+    packages = lock["packages"]
+    spec = json.loads((main_dir / "package.json").read_text())["dependencies"]["lib"]
+    assert packages[""]["dependencies"] == {"lib": spec, "other": "^1.0.0"}
+    assert packages["packages/ws"]["peerDependencies"] == {"lib": spec}
+    assert packages["node_modules/other"] == {
+        "version": "1.0.0",
+        "resolved": "https://r/other",
+    }
+    assert "node_modules/lib/node_modules/dep" not in packages
+    if container_mode:
+        assert "node_modules/lib" not in packages
+    else:
+        assert packages["node_modules/lib"] == {"resolved": "../lib", "link": True}
+        assert packages["../lib"] == {"name": "lib", "version": "2.0.0"}
+
+
+def test_patch_yarn_lock(tmp_path):
+    (tmp_path / "yarn.lock").write_text(
+        """# yarn lockfile v1
+
+
+"@scope/lib@^1.0.0", "@scope/lib@^1.1.0":
+  version "1.1.0"
+  resolved "https://r/@scope/lib-1.1.0.tgz"
+
+lib@^1.0.0:
+  version "1.0.0"
+  dependencies:
+    other "^1.0.0"
+
+other@^1.0.0:
+  version "1.0.0"
+"""
+    )
+
+    assert javascript.patch_yarn_lock(str(tmp_path), {"lib", "@scope/lib"})
+
+    assert (tmp_path / "yarn.lock").read_text() == (
+        '# yarn lockfile v1\n\nother@^1.0.0:\n  version "1.0.0"\n'
+    )
+
+
+def test_patch_pnpm_lock(tmp_path):
+    (tmp_path / "pnpm-lock.yaml").write_text(
+        """lockfileVersion: '9.0'
+
+settings:
+  autoInstallPeers: true
+
+importers:
+
+  .:
+    dependencies:
+      '@org/lib':
+        specifier: ^1.0.0
+        version: 1.0.0
+      other:
+        specifier: ^1.0.0
+        version: 1.0.0
+
+  packages/a:
+    devDependencies:
+      '@org/lib':
+        specifier: ^1.0.0
+        version: 1.0.0
+
+packages:
+
+  '@org/lib@1.0.0':
+    resolution: {integrity: sha512-lib}
+
+  other@1.0.0:
+    resolution: {integrity: sha512-other}
+
+snapshots:
+
+  other@1.0.0: {}
+
+  '@org/lib@1.0.0':
+    dependencies:
+      other: 1.0.0
+"""
+    )
+
+    assert javascript.patch_pnpm_lock(str(tmp_path), {"@org/lib"})
+
+    # only the entries of the replaced dependencies are removed
+    assert (tmp_path / "pnpm-lock.yaml").read_text() == """lockfileVersion: '9.0'
+
+settings:
+  autoInstallPeers: true
+
+importers:
+
+  .:
+    dependencies:
+      other:
+        specifier: ^1.0.0
+        version: 1.0.0
+
+  packages/a:
+    devDependencies: {}
+
+packages:
+
+  other@1.0.0:
+    resolution: {integrity: sha512-other}
+
+snapshots:
+
+  other@1.0.0: {}
+"""
+    assert not javascript.patch_pnpm_lock(str(tmp_path), {"@org/lib"})
+
+
+def test_patch_pnpm_lock_v5(tmp_path):
+    (tmp_path / "pnpm-lock.yaml").write_text(
+        """lockfileVersion: 5.4
+
+specifiers:
+  lib: ^1.0.0
+  other: ^1.0.0
+
+dependencies:
+  lib: 1.0.0
+  other: 1.0.0
+
+packages:
+
+  /lib/1.0.0:
+    resolution: {integrity: sha512-lib}
+    dev: false
+
+  /other/1.0.0:
+    resolution: {integrity: sha512-other}
+    dev: false
+"""
+    )
+
+    assert javascript.patch_pnpm_lock(str(tmp_path), {"lib"})
+
+    lock = yaml.safe_load((tmp_path / "pnpm-lock.yaml").read_text())
+    assert lock["specifiers"] == {"other": "^1.0.0"}
+    assert lock["dependencies"] == {"other": "1.0.0"}
+    assert list(lock["packages"]) == ["/other/1.0.0"]
+
+
+def test_patch_package_lock_npm_ci(tmp_path):
+    if shutil.which("npm") is None:
+        pytest.skip("npm not installed")
+    write_json(tmp_path / "old" / "package.json", {"name": "lib", "version": "1.0.0"})
+    write_json(tmp_path / "lib" / "package.json", {"name": "lib", "version": "2.0.0"})
+    main_dir = tmp_path / "main"
+    write_json(
+        main_dir / "package.json",
+        {"name": "main", "version": "1.0.0", "dependencies": {"lib": "file:../old"}},
+    )
+    npm_args = ["--offline", "--no-audit", "--no-fund", "--ignore-scripts"]
+    subprocess.run(["npm", "install"] + npm_args, cwd=main_dir, check=True)
+    dirs = {"github.com/org/lib": {"path": str(tmp_path / "lib")}}
+
+    assert javascript.process_javascript(str(main_dir), dirs, False)
+
+    subprocess.run(["npm", "ci"] + npm_args, cwd=main_dir, check=True)
+    installed = json.loads(
+        (main_dir / "node_modules" / "lib" / "package.json").read_text()
+    )
+    assert installed["version"] == "2.0.0"
+
+
+@pytest.mark.parametrize(
+    "files",
+    [
+        {"package.json": {"name": "mono", "workspaces": ["packages/*", "!**/c"]}},
+        {
+            "package.json": {
+                "name": "mono",
+                "workspaces": {"packages": ["packages/[ab]"]},
+            }
+        },
+        {
+            "package.json": {"name": "mono"},
+            "pnpm-workspace.yaml": "packages:\n  - 'packages/*'\n  - '!packages/c'\n",
+        },
+    ],
+)
+def test_local_dependencies_workspaces(tmp_path, monkeypatch, files):
+    mono = tmp_path / "mono"
+    mono.mkdir()
+    for fname, content in files.items():
+        if isinstance(content, dict):
+            write_json(mono / fname, content)
+        else:
+            (mono / fname).write_text(content)
+    write_json(mono / "packages" / "a" / "package.json", {"name": "@mono/a"})
+    write_json(mono / "packages" / "b" / "package.json", {"name": "@mono/b"})
+    write_json(mono / "packages" / "c" / "package.json", {"name": "@mono/c"})
+    (mono / "packages" / "no-package").mkdir()
+    info = {
+        "path": str(mono),
+        "fork_url": "https://github.com/fork/mono",
+        "branch": "b",
+    }
+    monkeypatch.setattr(javascript, "_PACKAGE_INDEX_CACHE", {})
+
+    deps = javascript.local_dependencies({"github.com/org/mono": info})
+
+    assert deps == {
+        "mono": info,
+        "@mono/a": dict(info, path=str(mono / "packages" / "a"), subdir="packages/a"),
+        "@mono/b": dict(info, path=str(mono / "packages" / "b"), subdir="packages/b"),
+    }
+
+    # the workspaces are scanned once
+    def fail_glob(*args, **kwargs):
+        pytest.fail("scanned again")
+
+    monkeypatch.setattr(javascript, "get_workspace_dirs", fail_glob)
+    assert javascript.local_dependencies({"github.com/org/mono": info}) == deps
+
+
+def test_process_javascript_unchanged(workspace):
+    main_dir, dirs = workspace
+    assert javascript.process_javascript(str(main_dir), dirs, False)
+    mtime = (main_dir / "package.json").stat().st_mtime_ns
+
+    assert not javascript.process_javascript(str(main_dir), dirs, False)
+    assert (main_dir / "package.json").stat().st_mtime_ns == mtime
+
+
+# test_javascript.py ends here
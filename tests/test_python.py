@@ -1,3 +1,4 @@
+import os
 import pathlib
 
 import pytest
@@ -160,3 +161,366 @@ setup(
     # Assert
     assert result is not None
     assert result == "depends-on"
+
+
+PYPROJECT = """[project]
+name = "main"
+description = \"\"\"
+[tool.poetry.dependencies]
+my_lib = "1"
+\"\"\"
+dependencies = [
+    "requests>=2",  # http
+    "My.Lib[extra] >= 1.0 ; python_version >= \\"3.8\\"",
+    'uv-lib',
+]
+
+[project.optional-dependencies]
+dev = ["my-lib==1.0", "pytest"]
+
+[tool.poetry.dependencies]
+python = "^3.8"
+my-lib = { version = "^1.0" }  # keep comment
+"my_lib2" = [
+    { version = "1", python = "<3.9" },
+    { version = "2", python = ">=3.9" },
+]
+unrelated = "my_lib"
+
+[tool.uv.sources]
+uv_lib = { git = "https://github.com/org/uv-lib" }
+"""
+
+MODULE_DIRS = {
+    "my-lib": {
+        "path": "/src/my-lib",
+        "fork_url": "https://github.com/fork/my-lib",
+        "branch": "feature",
+    },
+    "my-lib2": {
+        "path": "/src/my-lib2",
+        "fork_url": "https://github.com/fork/my-lib2",
+        "branch": "feature",
+        "subdir": "sub",
+    },
+    "uv-lib": {
+        "path": "/src/uv-lib",
+        "fork_url": "https://github.com/fork/uv-lib",
+        "branch": "feature",
+    },
+}
+
+
+@pytest.mark.parametrize(
+    "container_mode, expected_content",
+    [
+        (
+            False,
+            """[project]
+name = "main"
+description = \"\"\"
+[tool.poetry.dependencies]
+my_lib = "1"
+\"\"\"
+dependencies = [
+    "requests>=2",  # http
+    "My.Lib[extra] @ file:///src/my-lib ; python_version >= \\"3.8\\"",
+    'uv-lib',
+]
+
+[project.optional-dependencies]
+dev = ["my-lib @ file:///src/my-lib", "pytest"]
+
+[tool.poetry.dependencies]
+python = "^3.8"
+my-lib = { path = "/src/my-lib" }  # keep comment
+"my_lib2" = { path = "/src/my-lib2" }
+unrelated = "my_lib"
+
+[tool.uv.sources]
+uv_lib = { path = "/src/uv-lib", editable = true }
+""",
+        ),
+        (
+            True,
+            """[project]
+name = "main"
+description = \"\"\"
+[tool.poetry.dependencies]
+my_lib = "1"
+\"\"\"
+dependencies = [
+    "requests>=2",  # http
+    "My.Lib[extra] @ git+https://github.com/fork/my-lib@feature ; python_version >= \\"3.8\\"",
+    'uv-lib',
+]
+
+[project.optional-dependencies]
+dev = ["my-lib @ git+https://github.com/fork/my-lib@feature", "pytest"]
+
+[tool.poetry.dependencies]
+python = "^3.8"
+my-lib = { git = "https://github.com/fork/my-lib", branch = "feature" }  # keep comment
+"my_lib2" = { git = "https://github.com/fork/my-lib2", branch = "feature", subdirectory = "sub" }
+unrelated = "my_lib"
+
+[tool.uv.sources]
+uv_lib = { git = "https://github.com/fork/uv-lib", branch = "feature" }
+""",
+        ),
+    ],
+)
+def test_rewrite_pyproject(container_mode, expected_content):
+    content, replaced = python.rewrite_pyproject(PYPROJECT, MODULE_DIRS, container_mode)
+
+    assert content == expected_content
+    assert replaced == ["My.Lib", "my-lib", "my-lib", "my_lib2", "uv_lib"]
+
+
+def test_rewrite_pyproject_no_match():
+    content, replaced = python.rewrite_pyproject(
+        '[project]\nname = "my-lib"\ndependencies = ["requests"]\n',
+        MODULE_DIRS,
+        False,
+    )
+
+    assert content == '[project]\nname = "my-lib"\ndependencies = ["requests"]\n'
+    assert replaced == []
+
+
+def test_get_modules(tmp_path, monkeypatch):
+    files = {
+        "setuppy": {"setup.py": 'setup(\n    name="Setup_Py",\n)\n'},
+        "setupcfg": {
+            "setup.py": "setup()\n",
+            "setup.cfg": "[metadata]\nname = setup.cfg\n",
+        },
+        "poetry": {
+            "pyproject.toml": '[tool.poetry]\nname = "Poetry-Lib"\n\n'
+            '[tool.poetry.dependencies]\nname = "not-the-name"\n'
+        },
+        "noname": {"pyproject.toml": '[project]\nversion = "1.0"\n'},
+        "golang": {"go.mod": "module github.com/org/golang\n"},
+    }
+    dirs = {}
+    for name, contents in files.items():
+        (tmp_path / name).mkdir()
+        for fname, content in contents.items():
+            (tmp_path / name / fname).write_text(content)
+        dirs[f"github.com/org/{name}"] = {"path": str(tmp_path / name)}
+    monkeypatch.setattr(python, "_NAME_CACHE", {})
+
+    modules = python.get_modules(dirs)
+
+    assert modules == {
+        "setup-py": dirs["github.com/org/setuppy"],
+        "setup-cfg": dirs["github.com/org/setupcfg"],
+        "poetry-lib": dirs["github.com/org/poetry"],
+    }
+
+    # the names are cached until the files change
+    def fail_lookup(fname):
+        pytest.fail("looked up again")
+
+    monkeypatch.setattr(python, "lookup_setuppy_name", fail_lookup)
+    assert python.get_modules(dirs) == modules
+    (tmp_path / "poetry" / "setup.py").write_text("setup()\n")
+    with pytest.raises(pytest.fail.Exception):
+        python.get_modules(dirs)
+
+
+def test_process_python_no_manifest(tmp_path, monkeypatch):
+    (tmp_path / "go.mod").write_text("module github.com/org/main\n")
+
+    # the dependencies are not looked up for non Python projects
+    def fail_get_modules(dirs):
+        pytest.fail("get_modules called")
+
+    monkeypatch.setattr(python, "get_modules", fail_get_modules)
+    assert not python.process_python(str(tmp_path), MODULE_DIRS, False)
+
+
+@pytest.mark.parametrize(
+    "container_mode, expected_requirements, expected_dev",
+    [
+        (
+            False,
+            """# main requirements
+requests==2.31.0
+-e /src/my-lib[extra]
+my-lib2 @ file:///src/my-lib2 ; python_version >= "3.8"
+-r dev.txt
+--constraint=constraints.txt
+-r ../outside.txt
+""",
+            """-r requirements.txt
+-e /src/uv-lib
+pytest==8.0.0
+""",
+        ),
+        (
+            True,
+            """# main requirements
+requests==2.31.0
+My_Lib[extra] @ git+https://github.com/fork/my-lib@feature
+my-lib2 @ git+https://github.com/fork/my-lib2@feature#egg=subdir&subdirectory=sub ; python_version >= "3.8"
+-r dev.txt
+--constraint=constraints.txt
+-r ../outside.txt
+""",
+            """-r requirements.txt
+uv.lib @ git+https://github.com/fork/uv-lib@feature
+pytest==8.0.0
+""",
+        ),
+    ],
+)
+def test_process_python_requirements(
+    tmp_path, container_mode, expected_requirements, expected_dev
+):
+    main_dir = tmp_path / "main"
+    main_dir.mkdir()
+    (main_dir / "requirements.txt").write_text(
+        """# main requirements
+requests==2.31.0
+My_Lib[extra]==1.0  # pinned
+my-lib2==1.0 ; python_version >= "3.8"
+-r dev.txt
+--constraint=constraints.txt
+-r ../outside.txt
+"""
+    )
+    (main_dir / "dev.txt").write_text(
+        """-r requirements.txt
+uv.lib==1.0 \\
+    --hash=sha256:abcd \\
+    --hash=sha256:ef01
+pytest==8.0.0 \\
+    --hash=sha256:1234
+"""
+    )
+    (main_dir / "constraints.txt").write_text("my-lib<2\nrequests<3\n")
+    (tmp_path / "outside.txt").write_text("my-lib==1.0\n")
+
+    assert python.process_python_requirements(
+        str(main_dir), {}, container_mode, MODULE_DIRS
+    )
+
+    assert (main_dir / "requirements.txt").read_text() == expected_requirements
+    assert (main_dir / "dev.txt").read_text() == expected_dev
+    assert (main_dir / "constraints.txt").read_text() == (
+        "# my-lib: constraint removed for the local dependency\nrequests<3\n"
+    )
+    assert (tmp_path / "outside.txt").read_text() == "my-lib==1.0\n"
+    assert sorted(path.name for path in main_dir.iterdir()) == [
+        "constraints.txt",
+        "dev.txt",
+        "requirements.txt",
+    ]
+
+
+def test_process_python_requirements_hashes(tmp_path):
+    (tmp_path / "requirements.txt").write_text(
+        """--require-hashes
+requests==2.31.0 --hash=sha256:abcd  # pinned
+-r dev.txt
+"""
+    )
+    (tmp_path / "requirements.txt").chmod(0o600)
+    (tmp_path / "dev.txt").write_text(
+        """my-lib==1.0 \\
+    --hash=sha256:1234
+pytest==8.0.0 \\
+    --hash=sha256:5678 \\
+    --hash=sha256:9abc
+"""
+    )
+
+    assert python.process_python_requirements(str(tmp_path), {}, False, MODULE_DIRS)
+
+    # pip requires hashes for all the requirements or none
+    assert (tmp_path / "requirements.txt").read_text() == (
+        "requests==2.31.0  # pinned\n-r dev.txt\n"
+    )
+    assert (tmp_path / "requirements.txt").stat().st_mode & 0o777 == 0o600
+    assert (tmp_path / "dev.txt").read_text() == "-e /src/my-lib\npytest==8.0.0\n"
+
+
+@pytest.mark.parametrize(
+    "container_mode, expected_content",
+    [
+        (
+            False,
+            b"# crlf\r\n-e /src/my-lib[extra]\r\n-e /src/uv-lib\r\n"
+            b"my-lib2 @ file:///src/my-lib2 ; python_version >= '3.8'\r\n"
+            b"requests\r\n-e git+https://github.com/org/other#egg=other",
+        ),
+        (
+            True,
+            b"# crlf\r\nmy-lib[extra] @ git+https://github.com/fork/my-lib@feature\r\n"
+            b"uv_lib @ git+https://github.com/fork/uv-lib@feature\r\n"
+            b"my-lib2 @ git+https://github.com/fork/my-lib2@feature"
+            b"#egg=subdir&subdirectory=sub ; python_version >= '3.8'\r\n"
+            b"requests\r\n-e git+https://github.com/org/other#egg=other",
+        ),
+    ],
+)
+def test_process_python_requirements_vcs_crlf(
+    tmp_path, container_mode, expected_content
+):
+    (tmp_path / "requirements.txt").write_bytes(
+        b"# crlf\r\n-e git+https://github.com/org/my-lib@main#egg=my-lib[extra]\r\n"
+        b"git+https://github.com/org/uv-lib#subdirectory=.&egg=uv_lib\r\n"
+        b"my-lib2==1.0 ; python_version >= '3.8'\r\n"
+        b"requests\r\n-e git+https://github.com/org/other#egg=other"
+    )
+
+    assert python.process_python_requirements(
+        str(tmp_path), {}, container_mode, MODULE_DIRS
+    )
+
+    assert (tmp_path / "requirements.txt").read_bytes() == expected_content
+
+
+def test_update_python_locks(tmp_path, monkeypatch):
+    bin_dir = tmp_path / "bin"
+    bin_dir.mkdir()
+    calls = tmp_path / "calls"
+    for tool in ("uv", "poetry"):
+        script = bin_dir / tool
+        script.write_text(f'#!/bin/sh\necho {tool} "$@" >> {calls}\n')
+        script.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{bin_dir}{os.pathsep}{os.environ['PATH']}")
+    main_dir = tmp_path / "main"
+    main_dir.mkdir()
+
+    assert not python.update_python_locks(str(main_dir), ["my-lib"])
+    assert not calls.exists()
+
+    (main_dir / "uv.lock").write_text("")
+    (main_dir / "poetry.lock").write_text("")
+    assert python.update_python_locks(str(main_dir), ["My.Lib", "other", "my-lib"])
+    assert calls.read_text() == (
+        "uv lock --upgrade-package my-lib --upgrade-package other\n"
+        "poetry update --lock my-lib other\n"
+    )
+
+    monkeypatch.setenv("DEPENDS_ON_PYTHON_LOCK", "false")
+    assert not python.update_python_locks(str(main_dir), ["my-lib"])
+
+
+def test_process_python_pyproject_relock_once(tmp_path, monkeypatch):
+    (tmp_path / "pyproject.toml").write_text(
+        '[project]\nname = "main"\ndependencies = ["my-lib>=1.0"]\n'
+    )
+    calls = []
+    monkeypatch.setattr(
+        python, "update_python_locks", lambda main_dir, names: calls.append(names)
+    )
+
+    assert python.process_python_pyproject(str(tmp_path), {}, False, MODULE_DIRS)
+    assert calls == [["my-lib"]]
+
+    # pyproject.toml is unchanged so the lock files are up to date
+    assert python.process_python_pyproject(str(tmp_path), {}, False, MODULE_DIRS)
+    assert calls == [["my-lib"]]
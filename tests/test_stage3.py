@@ -0,0 +1,120 @@
+import json
+import subprocess
+
+import pytest
+
+import depends_on.stage3 as stage3
+
+
+def make_repo(path, origin_url, extra_config=None):
+    subprocess.run(["git", "init", "--quiet", str(path)], check=True)
+    subprocess.run(["git", "remote", "add", "origin", origin_url], cwd=path, check=True)
+    for key, value in (extra_config or {}).items():
+        subprocess.run(["git", "config", key, value], cwd=path, check=True)
+
+
+@pytest.mark.parametrize(
+    "config, expected_url",
+    [
+        (
+            '[core]\n\tbare = false\n[remote "origin"]\n'
+            "\turl = git@github.com:org/repo.git\n"
+            "\tfetch = +refs/heads/*:refs/remotes/origin/*\n",
+            "git@github.com:org/repo.git",
+        ),
+        (
+            '[remote "fork"]\n\turl = https://github.com/fork/repo\n'
+            '[remote "origin"]\n\turl = https://github.com/org/repo\n',
+            "https://github.com/org/repo",
+        ),
+        ("[core]\n\tbare = false\n", None),
+        (
+            '[remote "origin"]\n\turl = https://github.com/org/repo\n'
+            '[url "https://mirror/"]\n\tinsteadOf = https://github.com/\n',
+            None,
+        ),
+        ("[include]\n\tpath = other\n", None),
+        (
+            '[Remote "origin"]\n\tURL = https://github.com/org/repo\n',
+            "https://github.com/org/repo",
+        ),
+        (
+            "[remote.origin]\n\turl = https://github.com/org/repo\n",
+            "https://github.com/org/repo",
+        ),
+        ('[remote "Origin"]\n\turl = https://github.com/org/repo\n', None),
+    ],
+)
+def test_read_origin_url(tmp_path, monkeypatch, config, expected_url):
+    monkeypatch.setattr(stage3, "_GLOBAL_URL_REWRITES", False)
+    config_file = tmp_path / "config"
+    config_file.write_text(config)
+    assert stage3.read_origin_url(config_file) == expected_url
+
+
+@pytest.mark.parametrize("rewrite", [False, True])
+def test_read_origin_url_global_rewrite(tmp_path, monkeypatch, rewrite):
+    global_config = tmp_path / "gitconfig"
+    global_config.write_text(
+        '[url "https://mirror/"]\n\tinsteadOf = https://github.com/\n'
+        if rewrite
+        else "[core]\n\tbare = false\n"
+    )
+    monkeypatch.setenv("GIT_CONFIG_GLOBAL", str(global_config))
+    monkeypatch.setenv("GIT_CONFIG_NOSYSTEM", "1")
+    monkeypatch.setattr(stage3, "_GLOBAL_URL_REWRITES", None)
+    repo = tmp_path / "repo"
+    make_repo(repo, "https://github.com/org/repo")
+
+    origin_url = stage3.read_origin_url(repo / ".git" / "config")
+
+    if rewrite:
+        assert origin_url is None
+        assert stage3.get_remote_url(repo) == "https://mirror/org/repo"
+    else:
+        assert origin_url == "https://github.com/org/repo"
+
+
+def test_directories(tmp_path, monkeypatch):
+    main_dir = tmp_path / "main"
+    make_repo(main_dir, "https://github.com/org/main")
+    make_repo(tmp_path / "lib", "git@github.com:org/lib.git")
+    (tmp_path / "lib" / "depends-on.json").write_text(
+        json.dumps({"branch": "feature", "subdir": "sub"})
+    )
+    make_repo(
+        tmp_path / "rewritten",
+        "gh:org/rewritten",
+        {"url.https://github.com/.insteadOf": "gh:"},
+    )
+    (tmp_path / "not-a-repo").mkdir()
+    (tmp_path / "file").write_text("")
+
+    dirs = stage3.directories(str(tmp_path), str(main_dir))
+
+    assert sorted(dirs) == ["github.com/org/lib", "github.com/org/rewritten"]
+    assert dirs["github.com/org/lib"]["path"] == str(tmp_path / "lib" / "sub")
+    assert dirs["github.com/org/lib"]["branch"] == "feature"
+    assert dirs["github.com/org/rewritten"]["path"] == str(tmp_path)
+    assert (tmp_path / stage3.INDEX_FILE).exists()
+
+    # the next calls reuse the index for the unchanged repositories
+    def fail_scan(*args):
+        pytest.fail("scanned again")
+
+    monkeypatch.setattr(stage3, "scan_repository", fail_scan)
+    assert stage3.directories(str(tmp_path), str(main_dir)) == dirs
+    monkeypatch.undo()
+
+    # the paths of the index are not reused through another spelling of top_dir
+    link = tmp_path.parent / f"{tmp_path.name}-link"
+    link.symlink_to(tmp_path)
+    dirs = stage3.directories(str(link), str(link / "main"))
+    assert dirs["github.com/org/lib"]["path"] == str(link / "lib" / "sub")
+    assert dirs["github.com/org/rewritten"]["path"] == str(link)
+    assert stage3.directories(str(tmp_path), str(main_dir))[
+        "github.com/org/rewritten"
+    ]["path"] == str(tmp_path)
+
+
+# test_stage3.py ends here
@@ -0,0 +1,70 @@
+import depends_on.trace as trace
+
+
+def test_span_disabled(tmp_path, monkeypatch):
+    monkeypatch.delenv("DEPENDS_ON_TRACE", raising=False)
+    with trace.span("noop", "test"):
+        pass
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_span(tmp_path, monkeypatch):
+    trace_file = tmp_path / "trace.jsonl"
+    monkeypatch.setenv("DEPENDS_ON_TRACE", str(trace_file))
+
+    @trace.traced("processor")
+    def process_test():
+        with trace.span("git fetch", "git", repo="lib"):
+            pass
+        return 42
+
+    assert process_test() == 42
+
+    events = trace.load_events(trace_file)
+    assert [(e["name"], e["cat"]) for e in events] == [
+        ("git fetch", "git"),
+        ("process_test", "processor"),
+    ]
+    assert events[0]["ph"] == "X"
+    assert events[0]["args"] == {"repo": "lib"}
+    assert events[1]["dur"] >= events[0]["dur"]
+
+
+def test_span_relative_trace_file(tmp_path, monkeypatch):
+    (tmp_path / "repo").mkdir()
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setenv("DEPENDS_ON_TRACE", "trace.jsonl")
+
+    with trace.span("stage2", "stage"):
+        monkeypatch.chdir(tmp_path / "repo")
+        with trace.span("git fetch", "git"):
+            pass
+
+    events = trace.load_events(tmp_path / "trace.jsonl")
+    assert [e["name"] for e in events] == ["git fetch", "stage2"]
+    assert not (tmp_path / "repo" / "trace.jsonl").exists()
+
+
+def test_write_summary(tmp_path, monkeypatch):
+    trace_file = tmp_path / "trace.jsonl"
+    summary_file = tmp_path / "summary.md"
+    monkeypatch.setenv("DEPENDS_ON_TRACE", str(trace_file))
+    monkeypatch.setenv("GITHUB_STEP_SUMMARY", str(summary_file))
+    for name, cat, dur in (
+        ("git clone", "git", 3_000_000),
+        ("git fetch", "git", 1_000_000),
+        ("GET https://api.github.com/x", "http", 500_000),
+    ):
+        trace.write_event(
+            trace_file, {"name": name, "cat": cat, "ph": "X", "ts": 0, "dur": dur}
+        )
+
+    assert trace.write_summary()
+
+    summary = summary_file.read_text()
+    assert "| git | 2 | 4.00 | 3.00 |" in summary
+    assert "| http | 1 | 0.50 | 0.50 |" in summary
+    assert summary.index("git clone") < summary.index("git fetch")
+
+
+# test_trace.py ends here